@@ -1,13 +1,36 @@
 import numpy as np
 import os
+import io
 import torch
 from transformers import AutoProcessor, AutoModelForCausalLM
 import triton_python_backend_utils as pb_utils
+from PIL import Image
 import json
 import HyperParameters as hp
 
 MODEL_PATH = os.environ.get("MODEL_PATH")
 
+# Input size of the Florence 2 vision encoder, encoded images are only decoded as large as needed
+DECODE_SIZE = (768, 768)
+
+def request_image(request):
+    """
+    Image of a request and the (width, height) its answer refers to, from the encoded
+    image_bytes or from the FP32 image tensor
+    """
+    image_bytes = pb_utils.get_input_tensor_by_name(request, "image_bytes")
+    if image_bytes is not None:
+        image = Image.open(io.BytesIO(image_bytes.as_numpy().reshape(-1)[0]))
+        image_size = image.size
+        # Let the JPEG decoder downscale while decoding, the processor resizes to DECODE_SIZE anyway
+        image.draft("RGB", DECODE_SIZE)
+        return image.convert("RGB"), image_size
+
+    image = pb_utils.get_input_tensor_by_name(request, "image").as_numpy()
+    image_width = pb_utils.get_input_tensor_by_name(request, "image_width").as_numpy()[0]
+    image_height = pb_utils.get_input_tensor_by_name(request, "image_height").as_numpy()[0]
+    return image, (image_width, image_height)
+
 class TritonPythonModel:
     def initialize(self, args):
         # Load the Florence 2 processor
@@ -32,11 +55,9 @@ class TritonPythonModel:
         responses = []
         for request in requests:
             # Get inputs from request
-            image = pb_utils.get_input_tensor_by_name(request, "image").as_numpy()           
+            image, image_size = request_image(request)
             prompt_tensor = pb_utils.get_input_tensor_by_name(request, "prompt").as_numpy()
             txtinput_tensor = pb_utils.get_input_tensor_by_name(request, "text_input").as_numpy()
-            image_width = pb_utils.get_input_tensor_by_name(request, "image_width").as_numpy()[0]
-            image_height = pb_utils.get_input_tensor_by_name(request, "image_height").as_numpy()[0]
 
             # Decode the strings
             task_prompt = prompt_tensor[0].decode("utf-8")
@@ -68,7 +89,7 @@ class TritonPythonModel:
             answer_dict = self.processor.post_process_generation(
                 generated_text,
                 task=task_prompt,
-                image_size=(image_width, image_height)
+                image_size=image_size
             )
 
             # Convert the dictionary to a string
@@ -0,0 +1,157 @@
+import numpy as np
+import os
+import io
+import torch
+from transformers import AutoProcessor, AutoModelForCausalLM
+import triton_python_backend_utils as pb_utils
+from PIL import Image
+import json
+import HyperParameters as hp
+
+MODEL_PATH = os.environ.get("MODEL_PATH")
+MODEL_VERSION = os.environ.get("MODEL_VERSION")
+
+# run_tasks uses private methods of the Florence 2 remote code to encode the image once per
+# request, they were checked against this revision of microsoft/Florence-2-base. Bumping
+# MODEL_VERSION in the Dockerfile means checking them again and updating the pin
+REMOTE_CODE_REVISION = "ee1f1f163f352801f3b7af6b2b96e4baaa6ff2ff"
+REMOTE_CODE_METHODS = {
+    "model": ("_encode_image", "_merge_input_ids_with_image_features"),
+    "processor": ("_construct_prompts",),
+}
+
+# Tasks whose output is a caption, and tasks that ground the caption before them
+CAPTION_TASKS = ("<CAPTION>", "<DETAILED_CAPTION>", "<MORE_DETAILED_CAPTION>")
+GROUNDING_TASKS = ("<CAPTION_TO_PHRASE_GROUNDING>",)
+
+# Input size of the Florence 2 vision encoder, encoded images are only decoded as large as needed
+DECODE_SIZE = (768, 768)
+
+def request_image(request):
+    """
+    Image of a request and the (width, height) its answer refers to, from the encoded
+    image_bytes or from the FP32 image tensor
+    """
+    image_bytes = pb_utils.get_input_tensor_by_name(request, "image_bytes")
+    if image_bytes is not None:
+        image = Image.open(io.BytesIO(image_bytes.as_numpy().reshape(-1)[0]))
+        image_size = image.size
+        # Let the JPEG decoder downscale while decoding, the processor resizes to DECODE_SIZE anyway
+        image.draft("RGB", DECODE_SIZE)
+        return image.convert("RGB"), image_size
+
+    image = pb_utils.get_input_tensor_by_name(request, "image").as_numpy()
+    image_width = pb_utils.get_input_tensor_by_name(request, "image_width").as_numpy()[0]
+    image_height = pb_utils.get_input_tensor_by_name(request, "image_height").as_numpy()[0]
+    return image, (image_width, image_height)
+
+class TritonPythonModel:
+    def initialize(self, args):
+        # Fail loading the model instead of answering with errors after a revision bump
+        if MODEL_VERSION != REMOTE_CODE_REVISION:
+            raise RuntimeError(f"florence2multi is pinned to Florence 2 revision {REMOTE_CODE_REVISION}, got {MODEL_VERSION}")
+
+        # Load the Florence 2 processor
+        self.processor = AutoProcessor.from_pretrained(
+            MODEL_PATH,
+            local_files_only=True,
+            trust_remote_code=True
+        )
+
+        # Load the Florence 2 model for inference
+        self.model = AutoModelForCausalLM.from_pretrained(
+            MODEL_PATH,
+            local_files_only=True,
+            trust_remote_code=True
+        )
+
+        # Check if GPU is available and move the model to GPU if possible
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model.to(self.device)  # Move the model to GPU if available
+        self.model.eval()
+
+        for name, methods in REMOTE_CODE_METHODS.items():
+            missing = [method for method in methods if not hasattr(getattr(self, name), method)]
+            if missing:
+                raise RuntimeError(f"Florence 2 remote code of revision {MODEL_VERSION} has no {name} methods {missing}")
+
+    def execute(self, requests):
+        responses = []
+        for request in requests:
+            # Get inputs from request
+            tasks_tensor = pb_utils.get_input_tensor_by_name(request, "tasks").as_numpy()
+            tasks = [task.decode("utf-8") for task in tasks_tensor.reshape(-1)]
+
+            try:
+                image, image_size = request_image(request)
+                answer_dict = self.run_tasks(image, tasks, image_size)
+            except Exception as e:
+                responses.append(pb_utils.InferenceResponse(output_tensors=[], error=pb_utils.TritonError(str(e))))
+                continue
+
+            # Convert the dictionary to a string & encode it into bytes
+            answer = json.dumps(answer_dict).encode("utf-8")
+
+            # Prepare the final parsed answer as a response
+            inference_response = pb_utils.InferenceResponse(output_tensors=[
+                pb_utils.Tensor("answer", np.array([answer], dtype=object))
+            ])
+            responses.append(inference_response)
+
+        return responses
+
+    @torch.inference_mode()
+    def run_tasks(self, image, tasks, image_size):
+        '''
+        Run every task on the image, the vision encoder only runs once
+        '''
+        pixel_values = self.processor.image_processor(image, return_tensors="pt")["pixel_values"].to(self.device)
+        image_features = self.model._encode_image(pixel_values)
+
+        answer_dict = {}
+        caption = None
+        for task_prompt in tasks:
+            # Grounding tasks find the phrases of the last caption in the image
+            if task_prompt in GROUNDING_TASKS:
+                if caption is None:
+                    raise ValueError(f"{task_prompt} needs a caption task before it")
+                prompt = task_prompt + caption
+            else:
+                prompt = task_prompt
+
+            answer = self.generate(image_features, task_prompt, prompt, image_size)
+            if task_prompt in CAPTION_TASKS:
+                caption = answer[task_prompt]
+            answer_dict.update(answer)
+
+        return answer_dict
+
+    def generate(self, image_features, task_prompt, prompt, image_size):
+        # Tokenize the prompt the same way the processor does and merge it with the encoded image
+        input_ids = self.processor.tokenizer(
+            self.processor._construct_prompts([prompt]),
+            return_tensors="pt"
+        )["input_ids"].to(self.device)
+        inputs_embeds = self.model.get_input_embeddings()(input_ids)
+        inputs_embeds, _ = self.model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+
+        # Run inference using the Florence 2 model
+        generated_ids = self.model.generate(
+            input_ids=None,
+            inputs_embeds=inputs_embeds,
+            max_new_tokens=hp.max_new_tokens,
+            early_stopping=hp.early_stopping,
+            do_sample=hp.do_sample,
+            num_beams=hp.num_beams,
+        )
+
+        # Decode the generated ids into text & post-process it
+        generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
+        return self.processor.post_process_generation(
+            generated_text,
+            task=task_prompt,
+            image_size=image_size
+        )
+
+    def finalize(self):
+        pass  # Cleanup if necessary
@@ -0,0 +1,42 @@
+'''Helpers shared by the micro-benchmarks: a synthetic Sage sized frame and
+the timing of a call.'''
+
+import io
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image
+
+def synthetic_frame(width=4000, height=3000):
+    '''
+    JPEG bytes of a smooth frame with a little noise, compresses about like a real frame
+    '''
+    rng = np.random.default_rng(0)
+    coarse = Image.fromarray(rng.integers(0, 255, size=(30, 40, 3), dtype=np.uint8)).resize((width, height), Image.BILINEAR)
+    pixels = np.asarray(coarse, dtype=np.int16) + rng.integers(-4, 5, size=(height, width, 3), dtype=np.int16)
+    stream = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(stream, format="JPEG", quality=90)
+    return stream.getvalue()
+
+def measure(func, iterations, memory=False):
+    '''
+    Average wall time and CPU time of a call in ms, and with memory=True the peak
+    traced memory in MB (tracing slows the calls down)
+    '''
+    func() # warm up
+
+    if memory:
+        tracemalloc.start()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(iterations):
+        func()
+    cpu = (time.process_time() - cpu_start) / iterations
+    wall = (time.perf_counter() - wall_start) / iterations
+
+    result = {"wall_ms": wall * 1000, "cpu_ms": cpu * 1000}
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_mb"] = peak / 2**20
+    return result
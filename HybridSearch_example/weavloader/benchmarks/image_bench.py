@@ -0,0 +1,73 @@
+'''Micro-benchmark of the per frame image handling in the ingest path.
+Compares the old path (BytesIO + BufferedReader, image_encoder_b64, PIL decode
+and one FP32 conversion per Florence 2 call) with IngestImage at full
+resolution, and with IngestImage downscaling at ingest time.
+
+Run from the weavloader directory:
+    python -m benchmarks.image_bench --image static/frame.jpg --iterations 20
+Without --image a synthetic 12 MP JPEG (the size of a Sage frame) is used.'''
+
+import argparse
+import numpy as np
+import weaviate
+from io import BytesIO, BufferedReader
+from PIL import Image
+from image import IngestImage, CAPTION_MAX_SIZE, VECTOR_MAX_SIZE
+from benchmarks.common import synthetic_frame, measure
+
+# Florence 2 is called three times per image by triton_gen_caption
+CAPTION_CALLS = 3
+
+def old_path(image_data):
+    image_stream = BytesIO(image_data)
+    buffered_stream = BufferedReader(image_stream)
+    image_stream.seek(0)
+    encoded_image = weaviate.util.image_encoder_b64(buffered_stream)
+    image_stream.seek(0)
+    image = Image.open(image_stream).convert("RGB")
+    for _ in range(CAPTION_CALLS):
+        tensor = np.array(image).astype(np.float32)
+    return encoded_image, tensor
+
+def new_path(image_data):
+    image = IngestImage(image_data, caption_size=0, decode_size=0)
+    encoded_image = image.b64()
+    image.pixels()
+    for _ in range(CAPTION_CALLS):
+        tensor = image.tensor()
+    image.release()
+    return encoded_image, tensor
+
+def resize_path(image_data):
+    image = IngestImage(image_data)
+    encoded_image = image.encode(VECTOR_MAX_SIZE)
+    image.resized(CAPTION_MAX_SIZE)
+    for _ in range(CAPTION_CALLS):
+        tensor = image.tensor()
+    image.release()
+    return encoded_image, tensor
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="Image file to use, defaults to a synthetic 12 MP JPEG")
+    parser.add_argument("--iterations", type=int, default=10, help="Frames processed per path")
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            image_data = f.read()
+    else:
+        image_data = synthetic_frame()
+
+    print(f"Frame: {len(image_data) / 2**20:.1f} MB encoded, {args.iterations} iterations")
+
+    # Both paths must produce the same output
+    old_b64, old_tensor = old_path(image_data)
+    new_b64, new_tensor = new_path(image_data)
+    assert old_b64 == new_b64 and np.array_equal(old_tensor, new_tensor)
+
+    for name, func in (("before", old_path), ("after", new_path), ("resized", resize_path)):
+        result = measure(lambda: func(image_data), args.iterations, memory=True)
+        encoded_image, tensor = func(image_data)
+        print(f"{name:>7}: {result['wall_ms']:8.1f} ms wall  {result['cpu_ms']:8.1f} ms cpu  {result['peak_mb']:8.1f} MB peak"
+              f"  {len(encoded_image) / 2**20:6.2f} MB blob  {tensor.nbytes / 2**20:7.1f} MB tensor")
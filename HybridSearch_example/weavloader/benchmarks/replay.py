@@ -0,0 +1,115 @@
+'''Replays recorded loader fixtures against local stand-ins for
+sage_data_client, the manifest API, Triton and Weaviate, and reports the
+sustained images/sec and the per-stage latency of the loader.
+
+Record fixtures by running the loader with RECORD_DIR set, for example
+    docker run ... -e RECORD_DIR=/app/state/fixtures weavloader
+then copy the directory out and run from the weavloader directory:
+    python -m benchmarks.replay fixtures --rate 20 --triton-latency 0.3
+
+Loader settings are read from the environment as usual, so a change can be
+judged by running the replay before and after it with the same arguments.
+Leave DEDUP_ENABLED off with --loops, the repeated frames are near duplicates.'''
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+
+# The replay must not hit the caption cache or the spool, or re-record itself
+os.environ.setdefault("CAPTION_CACHE_PATH", "")
+os.environ.setdefault("SPOOL_DIR", "")
+os.environ["RECORD_DIR"] = ""
+
+def load_windows(directory, loops, server_url):
+    '''
+    Recorded watch() windows with image urls pointing at the fixture server,
+    every loop gets new urls so the loader sees new objects
+    '''
+    import pandas as pd
+    from recorder import url_key
+
+    windows = [pd.read_pickle(path) for path in sorted(glob.glob(os.path.join(directory, "windows", "*.pkl")))]
+    for loop in range(loops):
+        for df in windows:
+            df = df.copy()
+            df["value"] = [f"{server_url}/images/{url_key(url)}?loop={loop}" for url in df["value"]]
+            yield df
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", help="Directory recorded with RECORD_DIR")
+    parser.add_argument("--rate", type=float, default=0, help="Images per second fed to the loader, 0 feeds as fast as possible")
+    parser.add_argument("--loops", type=int, default=1, help="Times the recorded windows are replayed")
+    parser.add_argument("--triton-latency", type=float, default=0.2, help="Seconds the Triton stand-in takes per task")
+    parser.add_argument("--triton-instances", type=int, default=0, help="Requests the Triton stand-in serves at once, 0 is unlimited")
+    parser.add_argument("--insert-latency", type=float, default=0.01, help="Seconds the Weaviate stand-in takes per object")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    from benchmarks.standins import FixtureServer, StandInDataClient, StandInTriton, StandInAsyncTriton, StandInWeaviate
+
+    server = FixtureServer(args.fixtures).start()
+    os.environ["MANIFEST_API"] = f"{server.url}/manifests/"
+
+    # Import the loader only now so it picks up the stand-in settings
+    import sage_data_client
+    sage_data_client.query = StandInDataClient(args.fixtures).query
+    from data import Loader
+    from metrics import metrics
+    from triton_async import AsyncTriton, TRITON_ASYNC
+
+    weaviate_client = StandInWeaviate(args.insert_latency)
+    if TRITON_ASYNC:
+        triton_client = StandInAsyncTriton(args.triton_latency, args.triton_instances)
+        loader_triton = AsyncTriton("stand-in", connect=lambda url: triton_client)
+    else:
+        triton_client = StandInTriton(args.triton_latency, args.triton_instances)
+        loader_triton = triton_client
+    loader = Loader(None, weaviate_client, loader_triton).start()
+
+    fed = 0
+    start = time.perf_counter()
+    for df in load_windows(args.fixtures, args.loops, server.url):
+        loader.feed(df)
+        fed += len(df)
+
+        # Keep the feed rate, the pipeline blocks on its own when it is full
+        if args.rate > 0:
+            delay = fed / args.rate - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    loader.join()
+    elapsed = time.perf_counter() - start
+    loader.close()
+    if TRITON_ASYNC:
+        loader_triton.close()
+    server.close()
+
+    inserted = len(weaviate_client.collection.objects)
+    report = {
+        "images_fed": fed,
+        "images_inserted": inserted,
+        "elapsed_s": elapsed,
+        "images_per_s": inserted / elapsed if elapsed else 0.0,
+        "triton_requests": triton_client.calls,
+        "triton_request_mb": triton_client.request_bytes / 2**20,
+        "stages": loader.stats(),
+        "timings": metrics.snapshot()["timings"],
+    }
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2, default=str)
+        print()
+        return
+
+    print(f"Fed {fed} images, inserted {inserted} in {elapsed:.1f} s: {report['images_per_s']:.2f} images/s")
+    print(f"Triton: {triton_client.calls} requests, {report['triton_request_mb']:.1f} MB sent")
+    for name, stats in report["stages"].items():
+        print(f"  {name:>8}: {stats['workers']} workers, {stats['processed']} processed, {stats['avg_service_time'] * 1000:8.1f} ms avg")
+
+if __name__ == "__main__":
+    main()
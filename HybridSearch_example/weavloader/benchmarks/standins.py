@@ -0,0 +1,204 @@
+'''Local stand-ins for the services the loader talks to, used by replay.py.
+They serve recorded fixtures (images, manifests, GPS results) and simulate
+Triton and Weaviate with a configurable latency.'''
+
+import os
+import glob
+import asyncio
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tritonclient.grpc import _utils as triton_utils
+from tritonclient.utils import deserialize_bytes_tensor
+
+class FixtureServer:
+    '''
+    HTTP server for the recorded images (/images/<key>) and manifests (/manifests/<VSN>)
+    '''
+    def __init__(self, directory, host="127.0.0.1", port=0):
+        directory = os.path.abspath(directory)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                kind, _, name = self.path.split("?")[0].strip("/").partition("/")
+                if kind not in ("images", "manifests"):
+                    self.send_error(404)
+                    return
+                path = os.path.join(directory, kind, os.path.basename(name) + (".json" if kind == "manifests" else ""))
+                if not os.path.exists(path):
+                    self.send_error(404)
+                    return
+                with open(path, "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class StandInDataClient:
+    '''
+    Replaces sage_data_client.query for the GPS lookups with the recorded results
+    '''
+    def __init__(self, directory):
+        frames = [pd.read_pickle(path) for path in sorted(glob.glob(os.path.join(directory, "locations", "*.pkl")))]
+        frames = [df for df in frames if not df.empty]
+        self.locations = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def query(self, start=None, end=None, filter=None, tail=None, **kwargs):
+        if self.locations.empty or not filter or "vsn" not in filter:
+            return pd.DataFrame(columns=["timestamp", "name", "value", "meta.vsn"])
+        vsns = set(filter["vsn"].split("|"))
+        return self.locations[self.locations["meta.vsn"].isin(vsns)]
+
+class StandInTriton:
+    '''
+    Replaces the Triton client, requests are serialized like the real client does and
+    answered with a fixed caption after a simulated model latency per task. With instances
+    set, only that many requests are served at once like a model with that many instances.
+    '''
+    def __init__(self, latency=0.0, instances=0):
+        self.latency = latency
+        self.instances = instances
+        self.calls = 0
+        self.request_bytes = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(instances) if instances > 0 else None
+
+    def infer(self, model_name, inputs, outputs=None, **kwargs):
+        prompts = self._request(model_name, inputs, outputs)
+        if self._slots is None:
+            time.sleep(self._latency(prompts))
+        else:
+            with self._slots:
+                time.sleep(self._latency(prompts))
+        return _answer(prompts)
+
+    def async_infer(self, model_name, inputs, callback, outputs=None, **kwargs):
+        def run():
+            try:
+                result = self.infer(model_name, inputs, outputs)
+            except Exception as e:
+                callback(None, e)
+                return
+            callback(result, None)
+        threading.Thread(target=run, daemon=True).start()
+
+    def _request(self, model_name, inputs, outputs):
+        request = triton_utils._get_inference_request(
+            model_name=model_name, inputs=inputs, model_version="", request_id="", outputs=outputs,
+            sequence_id=0, sequence_start=False, sequence_end=False, priority=0, timeout=None, parameters=None,
+        )
+        size = request.ByteSize()
+        with self._lock:
+            self.calls += 1
+            self.request_bytes += size
+        # Inputs in shared memory have no content in the request
+        return {inp.name(): deserialize_bytes_tensor(inp._get_content()) for inp in inputs if inp.datatype() == "BYTES" and inp._get_content() is not None}
+
+    def _latency(self, prompts):
+        # The model generates once per task, a fused request saves the transfers but not the generation
+        return self.latency * len(prompts.get("tasks", [None]))
+
+class StandInAsyncTriton(StandInTriton):
+    '''
+    Replaces the tritonclient.grpc.aio client, used through AsyncTriton
+    '''
+    async def infer(self, model_name, inputs, outputs=None, **kwargs):
+        prompts = self._request(model_name, inputs, outputs)
+        if self.instances <= 0:
+            await asyncio.sleep(self._latency(prompts))
+        else:
+            # Created on the event loop of the first request
+            if self._slots is None or not isinstance(self._slots, asyncio.Semaphore):
+                self._slots = asyncio.Semaphore(self.instances)
+            async with self._slots:
+                await asyncio.sleep(self._latency(prompts))
+        return _answer(prompts)
+
+def _task_answer(task, text=""):
+    if task == "<MORE_DETAILED_CAPTION>":
+        return "A replayed frame of an outdoor scene."
+    return {"bboxes": [[0.0, 0.0, 1.0, 1.0]], "labels": ["outdoor scene" if task == "<CAPTION_TO_PHRASE_GROUNDING>" else "sky"]}
+
+def _answer(prompts):
+    # florence2multi gets a list of tasks, florence2base a single prompt
+    tasks = prompts["tasks"] if "tasks" in prompts else prompts["prompt"]
+    answer = json.dumps({task.decode("utf-8"): _task_answer(task.decode("utf-8")) for task in tasks}).encode("utf-8")
+    return SimpleNamespace(as_numpy=lambda name: np.array([answer], dtype=object))
+
+class _StandInBatch:
+    def __init__(self, collection):
+        self.collection = collection
+        self.objects = []
+        self.number_errors = 0
+
+    def __enter__(self):
+        return self
+
+    def add_object(self, properties, uuid=None, **kwargs):
+        self.objects.append((uuid, properties))
+
+    def __exit__(self, *exc):
+        # Vectorization cost is paid per object when the batch is sent
+        time.sleep(self.collection.insert_latency * len(self.objects))
+        with self.collection.lock:
+            for uuid, properties in self.objects:
+                self.collection.objects[str(uuid)] = properties
+        return False
+
+class StandInCollection:
+    '''
+    In-memory collection with the batch, data and query calls used by the loader
+    '''
+    def __init__(self, insert_latency=0.0):
+        self.insert_latency = insert_latency
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.batch = SimpleNamespace(
+            dynamic=lambda: _StandInBatch(self),
+            fixed_size=lambda **kwargs: _StandInBatch(self),
+            failed_objects=[],
+        )
+        self.query = SimpleNamespace(fetch_objects=self._fetch_objects)
+        self.data = SimpleNamespace(insert=self._insert, update=self._update)
+
+    def _fetch_objects(self, filters=None, limit=None, **kwargs):
+        return SimpleNamespace(objects=[])
+
+    def _insert(self, properties, uuid=None, **kwargs):
+        time.sleep(self.insert_latency)
+        with self.lock:
+            self.objects[str(uuid)] = properties
+        return uuid
+
+    def _update(self, uuid, properties, **kwargs):
+        with self.lock:
+            self.objects.setdefault(str(uuid), {}).update(properties)
+
+class StandInWeaviate:
+    '''
+    Replaces the weaviate client
+    '''
+    def __init__(self, insert_latency=0.0):
+        collection = StandInCollection(insert_latency)
+        self.collection = collection
+        self.collections = SimpleNamespace(get=lambda name: collection)
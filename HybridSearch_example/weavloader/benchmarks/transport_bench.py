@@ -0,0 +1,105 @@
+'''Benchmark of how the image is sent to Florence 2: the decoded FP32 caption
+input ("tensor", 12 bytes per pixel) or the caption input encoded as JPEG that
+Florence 2 decodes itself ("bytes"), each over gRPC or written into a system
+shared memory region ("shm", TRITON_SHM). Reports the gRPC request size, the
+client time to build & serialize a request from the downloaded bytes (decoding
+and downscaling included), the server time to decode the bytes, and with --url
+the end-to-end caption latency and client CPU against a running Triton on the
+same host.
+
+Run from the weavloader directory:
+    python -m benchmarks.transport_bench --image static/frame.jpg
+    python -m benchmarks.transport_bench --url localhost:8001 --iterations 5
+Without --image a synthetic 12 MP JPEG (the size of a Sage frame) is used.'''
+
+import io
+import argparse
+from PIL import Image
+from tritonclient.grpc import _utils as triton_utils
+import model
+import shm_pool
+from model import image_inputs, shared_image_inputs, triton_gen_caption, CAPTION_TASKS
+from image import IngestImage, CAPTION_MAX_SIZE
+from benchmarks.common import synthetic_frame, measure
+
+def build_request(image_data, transport, caption_size, pool=None):
+    '''
+    Serialized fused caption request, as the gRPC client sends it
+    '''
+    image = IngestImage(image_data, caption_size=caption_size)
+    region = None
+    if pool is not None:
+        inputs, region = shared_image_inputs(image, pool, transport)
+    else:
+        inputs = image_inputs(image, transport)
+    request = triton_utils._get_inference_request(
+        model_name="florence2multi", inputs=inputs, model_version="", request_id="", outputs=None,
+        sequence_id=0, sequence_start=False, sequence_end=False, priority=0, timeout=None, parameters=None,
+    )
+    if region is not None:
+        pool.release(region)
+    return request.SerializeToString()
+
+def server_decode(image_data):
+    '''
+    What florence2 does with image_bytes before the processor
+    '''
+    image = Image.open(io.BytesIO(image_data))
+    image.draft("RGB", (768, 768))
+    return image.convert("RGB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="Image file to use, defaults to a synthetic 12 MP JPEG")
+    parser.add_argument("--iterations", type=int, default=10, help="Requests built (or sent with --url) per transport")
+    parser.add_argument("--url", help="gRPC url of a running Florence 2 Triton server, e.g. localhost:8001")
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            image_data = f.read()
+    else:
+        image_data = synthetic_frame()
+
+    print(f"Frame: {Image.open(io.BytesIO(image_data)).size} {len(image_data) / 2**20:.2f} MB encoded, {args.iterations} iterations")
+
+    # Regions only used locally here, they are registered with Triton for --url
+    pool = shm_pool.RegionPool(count=1, region_size=max(shm_pool.TRITON_SHM_REGION_SIZE, 200 * 2**20), prefix="transport_bench")
+
+    # The tensor is sent once per task without the fused model
+    print(f"Request to florence2multi ({len(CAPTION_TASKS)} tasks, the per-task path sends {len(CAPTION_TASKS)} of them)")
+    variants = (
+        ("tensor", 0, None), ("tensor", CAPTION_MAX_SIZE, None), ("bytes", 0, None), ("bytes", CAPTION_MAX_SIZE, None),
+        ("tensor", 0, pool), ("tensor", CAPTION_MAX_SIZE, pool), ("bytes", 0, pool), ("bytes", CAPTION_MAX_SIZE, pool),
+    )
+    for transport, caption_size, shared in variants:
+        size = len(build_request(image_data, transport, caption_size, shared))
+        result = measure(lambda: build_request(image_data, transport, caption_size, shared), args.iterations)
+        name = f"{transport} ({caption_size or 'original'} px)"
+        name = f"{name} shm" if shared is not None else name
+        print(f"{name:>28}: {size / 2**20:8.2f} MB request  {result['wall_ms']:8.1f} ms wall  {result['cpu_ms']:8.1f} ms cpu to build")
+    pool.close()
+
+    # Part of building the downscaled requests, the loader decodes every image anyway for the vectorizer blob
+    result = measure(lambda: IngestImage(image_data).resized(CAPTION_MAX_SIZE), args.iterations)
+    name = f"client decode ({CAPTION_MAX_SIZE} px)"
+    print(f"{name:>28}: {result['wall_ms']:8.1f} ms wall  {result['cpu_ms']:8.1f} ms cpu included in the downscaled rows")
+
+    for caption_size in (0, CAPTION_MAX_SIZE):
+        sent = IngestImage(image_data, caption_size=caption_size).caption_bytes()
+        result = measure(lambda: server_decode(sent), args.iterations)
+        name = f"server decode ({caption_size or 'original'} px)"
+        print(f"{name:>28}: {result['wall_ms']:8.1f} ms wall  {result['cpu_ms']:8.1f} ms cpu per image sent as bytes")
+
+    if args.url:
+        import tritonclient.grpc as TritonClient
+        triton_client = TritonClient.InferenceServerClient(url=args.url)
+        print("End-to-end caption latency")
+        for shared in (False, True):
+            if shared:
+                shm_pool.open_region_pool(args.url)
+            for transport in ("tensor", "bytes"):
+                model.TRITON_IMAGE_TRANSPORT = transport
+                result = measure(lambda: triton_gen_caption(triton_client, IngestImage(image_data)), args.iterations)
+                name = f"{transport} shm" if shared else transport
+                print(f"{name:>28}: {result['wall_ms']:8.1f} ms wall  {result['cpu_ms']:8.1f} ms client cpu per image")
@@ -0,0 +1,248 @@
+'''This file contains the ingestion cursor, a persisted high-water mark of the
+last watch() window that was fully inserted into weaviate. On restart the
+loader resumes from it instead of from "now".'''
+
+import os
+import json
+import time
+import logging
+import threading
+import pandas as pd
+from collections import deque
+from metrics import metrics
+
+CURSOR_FILE = os.environ.get("CURSOR_FILE", "/app/state/cursor.json") # Set to "" to always start from now
+BACKFILL_PROGRESS_INTERVAL = float(os.environ.get("BACKFILL_PROGRESS_INTERVAL", 30)) # Seconds between backfill progress log lines
+
+def read_cursors(directory, single=os.path.basename(CURSOR_FILE)):
+    '''
+    Cursors of both layouts in the directory, {file name: cursor}. The cursor of a
+    single worker counts as a layout of one worker.
+    '''
+    cursors = {}
+    if not directory or not os.path.isdir(directory):
+        return cursors
+    for name in os.listdir(directory):
+        if not (name == single or (name.startswith("cursor-") and name.endswith(".json"))):
+            continue
+        try:
+            with open(os.path.join(directory, name), "r") as f:
+                cursors[name] = json.load(f)
+        except Exception as e:
+            logging.error(f"Failed to read cursor {name}: {e}")
+            continue
+        if name == single:
+            cursors[name]["worker_count"] = 1
+    return cursors
+
+def remove_cursors(directory, names):
+    for name in names:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    if names:
+        logging.debug(f"Removed the cursors {sorted(names)} of the previous worker layout")
+
+class Cursor:
+    '''
+    High-water mark stored in a small local file. Cursors left by sharded workers
+    (see ShardCursor) are taken into account, so scaling down to one worker resumes
+    from the oldest of them.
+    '''
+    def __init__(self, path=CURSOR_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''
+        Get the committed timestamp or None if there is nothing to resume from
+        '''
+        if not self.path:
+            return None
+        cursors = read_cursors(os.path.dirname(self.path), os.path.basename(self.path))
+        if not cursors:
+            return None
+        try:
+            oldest = min(pd.Timestamp(cursor["timestamp"]) for cursor in cursors.values())
+        except Exception as e:
+            logging.error(f"Failed to read cursor {self.path}, starting from now: {e}")
+            return None
+        if list(cursors) != [os.path.basename(self.path)]:
+            logging.debug(f"Worker layout changed, resuming from the oldest cursor {oldest}")
+        return oldest
+
+    def commit(self, timestamp):
+        '''
+        Persist the timestamp, only call this once every object up to it was inserted
+        '''
+        if not self.path:
+            return
+        self._write({"timestamp": pd.Timestamp(timestamp).isoformat()})
+        logging.debug(f"Cursor committed at {timestamp}")
+
+        # This worker loads every node and resumed from the oldest shard, their cursors are behind it
+        directory = os.path.dirname(self.path)
+        remove_cursors(directory, [name for name in read_cursors(directory, os.path.basename(self.path))
+                                   if name != os.path.basename(self.path)])
+
+    def _write(self, payload):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Write to a temp file first so a crash never leaves a half written cursor
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, self.path)
+
+class ShardCursor(Cursor):
+    '''
+    Cursor of one sharded loader worker, all workers keep their cursor in the same directory.
+    When the number of workers changed since the last commit, nodes may have moved to
+    another worker, so the worker resumes from the oldest cursor of all workers, including
+    the cursor of a single worker. Re-reading a window is safe since object IDs are deterministic.
+    '''
+    def __init__(self, worker_index, worker_count, directory=os.path.dirname(CURSOR_FILE)):
+        super().__init__(os.path.join(directory, f"cursor-{worker_index}.json") if directory else "")
+        self.directory = directory
+        self.worker_count = worker_count
+
+    def load(self):
+        cursors = read_cursors(self.directory)
+
+        own = cursors.get(os.path.basename(self.path))
+        if own is not None and own.get("worker_count") == self.worker_count:
+            return pd.Timestamp(own["timestamp"])
+
+        # The partitions changed, resume from the oldest position of any worker
+        if cursors:
+            oldest = min(pd.Timestamp(cursor["timestamp"]) for cursor in cursors.values())
+            logging.debug(f"Worker layout changed, resuming from the oldest cursor {oldest}")
+            return oldest
+        return None
+
+    def commit(self, timestamp):
+        if not self.path:
+            return
+        self._write({"timestamp": pd.Timestamp(timestamp).isoformat(), "worker_count": self.worker_count})
+        logging.debug(f"Cursor committed at {timestamp}")
+
+        # Once every worker of this layout committed, the cursors of the previous layout they are past are not needed
+        cursors = read_cursors(self.directory)
+        current = [cursors.get(f"cursor-{i}.json") for i in range(self.worker_count)]
+        if all(cursor is not None and cursor.get("worker_count") == self.worker_count for cursor in current):
+            oldest = min(pd.Timestamp(cursor["timestamp"]) for cursor in current)
+            remove_cursors(self.directory, [
+                name for name, cursor in cursors.items()
+                if cursor.get("worker_count") != self.worker_count and pd.Timestamp(cursor["timestamp"]) <= oldest
+            ])
+
+class BackfillCursor(Cursor):
+    '''
+    Checkpoint of a backfill between start and end, it is only resumed by a backfill
+    of the same range. Every commit also updates the progress and the ETA.
+    '''
+    def __init__(self, start, end, worker_index=None, directory=os.path.dirname(CURSOR_FILE)):
+        name = "backfill.json" if worker_index is None else f"backfill-{worker_index}.json"
+        super().__init__(os.path.join(directory, name) if directory else "")
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+        self._resumed_from = self.start
+        self._started = time.monotonic()
+        self._last_report = 0.0
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r") as f:
+                checkpoint = json.load(f)
+        except Exception as e:
+            logging.error(f"Failed to read backfill checkpoint {self.path}, starting over: {e}")
+            return None
+
+        if pd.Timestamp(checkpoint["start"]) != self.start or pd.Timestamp(checkpoint["end"]) != self.end:
+            logging.debug(f"Backfill checkpoint {self.path} is for another range, starting over")
+            return None
+
+        self._resumed_from = pd.Timestamp(checkpoint["timestamp"])
+        return self._resumed_from
+
+    def commit(self, timestamp):
+        if self.path:
+            self._write({
+                "timestamp": pd.Timestamp(timestamp).isoformat(),
+                "start": self.start.isoformat(),
+                "end": self.end.isoformat(),
+            })
+        self._report(pd.Timestamp(timestamp))
+
+    def _report(self, timestamp):
+        # Progress is measured in data time, the ETA assumes the rate so far holds
+        total = (self.end - self.start).total_seconds()
+        done = (min(timestamp, self.end) - self.start).total_seconds()
+        progress = done / total if total > 0 else 1.0
+
+        elapsed = time.monotonic() - self._started
+        loaded = (timestamp - self._resumed_from).total_seconds()
+        eta = (self.end - timestamp).total_seconds() * elapsed / loaded if loaded > 0 else None
+
+        metrics.set_gauge("backfill_progress", progress)
+        if eta is not None:
+            metrics.set_gauge("backfill_eta_seconds", eta)
+
+        now = time.monotonic()
+        if now - self._last_report >= BACKFILL_PROGRESS_INTERVAL or timestamp >= self.end:
+            self._last_report = now
+            eta_text = pd.Timedelta(seconds=round(eta)) if eta is not None else "unknown"
+            logging.debug(f"Backfill checkpoint at {timestamp}: {progress:.1%} done, ETA {eta_text}")
+
+class Window:
+    '''
+    A watch() window and the number of its rows still in flight
+    '''
+    def __init__(self, end, pending):
+        self.end = end
+        self.pending = pending
+
+class WindowTracker:
+    '''
+    Commits the cursor when a window and every window before it are done.
+    A row is done when it was inserted or dropped by the pipeline.
+    '''
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self._windows = deque()
+        self._lock = threading.Lock()
+
+    def open(self, end, size):
+        '''
+        Start tracking a window that ends at the given timestamp
+        '''
+        window = Window(end, size)
+        with self._lock:
+            self._windows.append(window)
+        if size == 0:
+            self._advance()
+        return window
+
+    def done(self, window):
+        '''
+        Mark one row of the window as done
+        '''
+        with self._lock:
+            window.pending -= 1
+        self._advance()
+
+    def _advance(self):
+        # Commit under the lock so two threads never write the cursor out of order
+        with self._lock:
+            committed = None
+            while self._windows and self._windows[0].pending <= 0:
+                committed = self._windows.popleft().end
+
+            if committed is not None:
+                try:
+                    self.cursor.commit(committed)
+                except Exception as e:
+                    logging.error(f"Failed to commit cursor at {committed}: {e}")
@@ -2,43 +2,531 @@
 These images will be the ones with which the hybrid search will compare
 the text query given by the user.'''
 
-import weaviate
 import os
 import pandas as pd
 import time
 import sage_data_client
 import requests
 import logging
-from PIL import Image
-from io import BytesIO, BufferedReader
-from model import triton_gen_caption
-from urllib.parse import urljoin
+from model import triton_gen_caption, triton_gen_caption_async, TRITON_FUSED, TRITON_IMAGE_TRANSPORT
+from image import IngestImage, CAPTION_MAX_SIZE, VECTOR_MAX_SIZE, THUMBNAIL_MAX_SIZE
+from manifest import ManifestCache
+from location import LocationResolver
+from writer import BatchWriter
+from pipeline import Pipeline, Stage, then
+from metrics import metrics
+from cursor import Cursor, ShardCursor, BackfillCursor, WindowTracker
+from ids import object_id, existing_ids, RecentIds
+from poller import AdaptivePoller
+from dedup import NearDuplicateFilter, suppress_duplicate, DEDUP_ENABLED
+from caption_cache import open_caption_cache, cached_caption, cached_caption_async
+from triton_async import AsyncTriton
+from recorder import recorder
+from fairqueue import FairQueue, FAIR_QUEUE
+from broker import BrokerSource, BROKER_URL, BROKER_QUEUE
+from sources import Source, SOURCE, open_archive_source
+from spool import open_spool, retryable, SPOOL_DIR, SPOOL_RETRY_INTERVAL
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from weaviate.classes.data import GeoCoordinate
 
-MANIFEST_API = os.environ.get("MANIFEST_API")
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", 2)) # Workers encoding & decoding images
+CAPTION_WORKERS = int(os.environ.get("CAPTION_WORKERS", 2)) # Workers waiting on Florence 2, the usual bottleneck
+INSERT_WORKERS = int(os.environ.get("INSERT_WORKERS", 1)) # Workers queueing objects for the batch writer
+DEFER_CAPTIONS = os.environ.get("DEFER_CAPTIONS", "false").lower() == "true" # Insert objects before they are captioned, the caption is filled in afterwards
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 2)) # Workers filling in deferred captions
+CATCHUP_WINDOW = os.environ.get("CATCHUP_WINDOW", "10min") # Time span of each query when catching up after a restart
+CATCHUP_WORKERS = int(os.environ.get("CATCHUP_WORKERS", 4)) # Max catch up queries running at the same time
+BACKFILL_WINDOW = os.environ.get("BACKFILL_WINDOW", "1h") # Time span of each query of a backfill
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", 4)) # Max backfill queries running at the same time
+BACKFILL_SPOOL_WAIT = float(os.environ.get("BACKFILL_SPOOL_WAIT", 600)) # Max seconds a finished backfill waits for its spooled images, the rest are retried by the next backfill
 
-def watch(start=None, filter=None):
+def watch(start=None, filter=None, poller=None):
     """
     Watches for incoming data and yields dataframes as new data is available.
+    The poll interval and the time span of each query are set by the adaptive poller.
     """
     if start is None:
         start = pd.Timestamp.utcnow()
 
+    if poller is None:
+        poller = AdaptivePoller()
+
     while True:
+        end, capped = poller.window_end(start, pd.Timestamp.utcnow())
+
+        query_start = time.perf_counter()
         df = sage_data_client.query(
             start=start,
+            end=end,
             filter=filter
         )
+        latency = time.perf_counter() - query_start
+
+        # start is inclusive, the rows at start were already seen by the last poll
+        new_rows = int((df.timestamp > start).sum()) if len(df) > 0 else 0
 
         if len(df) > 0:
             start = df.timestamp.max()
             yield df
 
-        time.sleep(3.0)
+        # When the span was capped it is older than the ingest lag and fully covered, move on even if it was empty
+        if capped:
+            start = max(start, end)
+
+        time.sleep(poller.update(new_rows, latency, capped))
+
+def catch_up(start, end, filter=None, window=CATCHUP_WINDOW, workers=CATCHUP_WORKERS):
+    """
+    Yields the dataframes between start and end in time order, the range is split
+    into windows that are queried concurrently with bounded parallelism.
+    """
+    bounds = list(pd.date_range(start, end, freq=window))
+    if not bounds or bounds[-1] < end:
+        bounds.append(end)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for window_start, window_end in zip(bounds[:-1], bounds[1:]):
+            pending.append(executor.submit(sage_data_client.query, start=window_start, end=window_end, filter=filter))
+
+            # Only keep a few windows in memory, yield the oldest first to keep the order
+            if len(pending) >= workers:
+                df = pending.popleft().result()
+                if len(df) > 0:
+                    yield df
 
-def continual_load(username, token, weaviate_client, triton_client):
+        while pending:
+            df = pending.popleft().result()
+            if len(df) > 0:
+                yield df
+
+def row_to_record(df, i):
+    '''
+    Turn a row of the sage_data_client DataFrame into a record passed through the pipeline
+    '''
+    return {
+        "url": df.value[i],
+        "timestamp": df.timestamp[i],
+        "vsn": df["meta.vsn"][i],
+        "filename": df["meta.filename"][i],
+        "camera": df["meta.camera"][i],
+        "host": df["meta.host"][i],
+        "job": df["meta.job"][i],
+        "node": df["meta.node"][i],
+        "plugin": df["meta.plugin"][i],
+        "task": df["meta.task"][i],
+        "zone": df["meta.zone"][i],
+    }
+
+def fetch_stage(fetcher, manifests, record):
     '''
-    Continously Load data to weaviate
+    Download the image and look up the manifest of the node
+    '''
+    # Get the image data, retried images may still have it from the spool. The spool keeps
+    # the encoded image without the bytes when it is over budget, the caption still needs them
+    if record.get("image") is None and (record.get("encoded_image") is None or record.get("caption") is None):
+        record["image"] = IngestImage(fetcher.fetch(record["url"]))
+
+        # Check if the response contains valid image data
+        if not record["image"].data:
+            logging.debug(f"Image skipped, empty content received for URL: {record['url']}")
+            return None
+
+    # Get the manifest, images of other sources may not come from a Sage node
+    if manifests is not None and not record["vsn"]:
+        logging.debug(f"Manifest skipped, no node for URL: {record['url']}")
+    record["manifest"] = manifests.get(record["vsn"]) if manifests is not None and record["vsn"] else {}
+    return record
+
+def decode_stage(dedup, record):
+    '''
+    Decode the image once, skip near duplicates and downscale it for the vectorizer,
+    the thumbnail and Florence 2
+    '''
+    # Retried images that were encoded before the failure
+    if record.get("encoded_image") is not None:
+        return record
+
+    image = record["image"]
+
+    # Prepare the caption input, the caption stage reuses it
+    caption_image = image.resized(CAPTION_MAX_SIZE)
+
+    # Static cameras produce many nearly identical frames
+    if dedup is not None and suppress_duplicate(dedup, record, caption_image):
+        image.release()
+        return None
+
+    # Blob vectorized by weaviate, the raw bytes when no resize is needed
+    record["encoded_image"] = image.encode(VECTOR_MAX_SIZE)
+
+    # Optional stored thumbnail
+    if THUMBNAIL_MAX_SIZE:
+        record["thumbnail"] = image.encode(THUMBNAIL_MAX_SIZE)
+
+    return record
+
+def caption_stage(triton_client, cache, record):
+    '''
+    Generate the caption with Florence 2, images captioned before come from the cache
+    '''
+    # Retried images that were captioned before the failure
+    if record.get("caption") is not None:
+        return record
+
+    # The image stays in the record until the caption succeeded, so a failure can spool it
+    image = record["image"]
+    caption = cached_caption(cache, image.data, lambda: triton_gen_caption(triton_client, image))
+    return captioned(record, caption)
+
+def async_caption_stage(triton, cache, record):
+    '''
+    caption_stage on an AsyncTriton, returns a future of the record so the worker can
+    hand the next image to Triton while this one is captioned
+    '''
+    if record.get("caption") is not None:
+        return record
+
+    image = record["image"]
+    caption = cached_caption_async(cache, image.data, lambda: triton_gen_caption_async(triton, image))
+    return then(caption, partial(captioned, record))
+
+def captioned(record, caption):
+    '''
+    Add the caption to the record, the pixels are not needed after captioning
+    '''
+    image = record.pop("image")
+    record["caption"] = caption
+    image.release()
+    return record
+
+def update_stage(collection, record):
+    '''
+    Fill in the caption of an object inserted without one, weaviate vectorizes it again with the caption
+    '''
+    with metrics.timer("caption_update"):
+        collection.data.update(uuid=record["uuid"], properties={"caption": record["caption"]})
+    metrics.observe("freshness_captioned", record_age(record))
+    logging.debug(f'Caption added: {record["url"]}')
+    return record
+
+def insert_stage(writer, record):
+    '''
+    Build the weaviate object and queue it in the batch writer
+    '''
+    manifest = record["manifest"]
+
+    # Extract fields from manifest
+    project = manifest.get('project', '')
+    address = manifest.get('address', '')
+    lat = manifest.get('gps_lat', '')
+    lon = manifest.get('gps_lon', '')
+
+    # Use the live lat & lon if the node has one
+    if record.get("location") is not None:
+        lat, lon = record["location"]
+
+    # Prepare data for insertion into Weaviate
+    data_properties = {
+        "filename": record["filename"],
+        "image": record["encoded_image"],
+        "timestamp": record["timestamp"].strftime('%y-%m-%d %H:%M Z'),
+        "link": record["url"],
+        "camera": record["camera"],
+        "host": record["host"],
+        "job": record["job"],
+        "node": record["node"],
+        "plugin": record["plugin"],
+        "task": record["task"],
+        "vsn": record["vsn"],
+        "zone": record["zone"],
+        "project": project,
+        "address": address,
+    }
+
+    # Images without a known location are still loaded
+    if lat not in ('', None) and lon not in ('', None):
+        data_properties["location"] = GeoCoordinate(latitude=float(lat), longitude=float(lon))
+
+    # With deferred captions the object is inserted first and the caption is filled in later
+    if record.get("caption") is not None:
+        data_properties["caption"] = record["caption"]
+
+    if record.get("thumbnail") is not None:
+        data_properties["thumbnail"] = record["thumbnail"]
+
+    writer.add(data_properties, uuid=record["uuid"], ref=record)
+    logging.debug(f'Image queued: {record["url"]}')
+    return record
+
+def record_age(record):
+    '''
+    Seconds since the image was published
+    '''
+    return (pd.Timestamp.utcnow() - record["timestamp"]).total_seconds()
+
+def log_skipped(stage, record, e):
+    '''
+    Log an image that was dropped by a pipeline stage
+    '''
+    url = record["url"]
+    if isinstance(e, requests.exceptions.HTTPError):
+        logging.debug(f"Image skipped, HTTPError for URL {url}: {e}")
+    elif isinstance(e, requests.exceptions.RequestException):
+        logging.debug(f"Image skipped, request failed for URL {url}: {e}")
+    else:
+        logging.debug(f"Image skipped, an error occurred in stage {stage} for URL {url}: {e}")
+
+class Loader:
+    '''
+    Runs the fetch -> decode -> caption -> insert pipeline and feeds it watch() windows.
+    If a cursor is given, it is committed once every row up to it was inserted or dropped.
+    If a partition is given, only the rows of the nodes it owns are loaded.
+    The source tells how images are read and if the rows come from Sage nodes, Sage by default.
+    Images failing on a transient error are spooled and fed again by the retry worker.
+    With deferred captions, objects are inserted as soon as they are encoded and a second
+    pipeline fills in their captions, so they are searchable by vector right away.
+    '''
+    def __init__(self, auth, weaviate_client, triton_client, cursor=None, partition=None, spool_dir=SPOOL_DIR,
+                 defer_captions=DEFER_CAPTIONS, source=None):
+        self.tracker = WindowTracker(cursor) if cursor is not None else None
+        self.partition = partition
+        source = source if source is not None else Source()
+
+        # Shared pooled session (or local reader) used by the fetch workers
+        self.fetcher = source.fetcher(auth)
+
+        # Node manifests rarely change, so they are cached per VSN
+        manifests = ManifestCache() if source.manifests else None
+
+        # Latest GPS fix per node, resolved once per window
+        self.locations = LocationResolver() if source.locations else None
+
+        # Objects are inserted in batches so they are vectorized together
+        self.collection = weaviate_client.collections.get("HybridSearchExample")
+        self.writer = BatchWriter(self.collection, on_flush=self._batch_done)
+
+        # IDs fed recently, these can still be in flight and not indexed yet
+        self.recent_ids = RecentIds()
+
+        # Recent frame hashes per camera to skip near duplicates
+        self.dedup = NearDuplicateFilter() if DEDUP_ENABLED else None
+
+        # Captions of images seen before, the model, the caption input size & how it is sent change the caption
+        caption_cache = open_caption_cache(model="florence2multi" if TRITON_FUSED else "florence2base",
+                                           caption_size=CAPTION_MAX_SIZE, transport=TRITON_IMAGE_TRANSPORT)
+
+        # Images that failed on a transient error, retried with backoff
+        self.spool = open_spool(spool_dir, partition)
+
+        # Frames wait for Florence 2 in a fair queue, so a busy node can not starve the others
+        scheduler = FairQueue("caption", on_shed=self._shed) if FAIR_QUEUE else None
+        if isinstance(triton_client, AsyncTriton):
+            # The workers only hand images over, twice the in-flight limit of Triton so the next
+            # requests are ready as soon as a slot frees up
+            caption = Stage("caption", partial(async_caption_stage, triton_client, caption_cache), workers=CAPTION_WORKERS,
+                            scheduler=scheduler, in_flight=2 * triton_client.capacity)
+        else:
+            caption = Stage("caption", partial(caption_stage, triton_client, caption_cache), workers=CAPTION_WORKERS, scheduler=scheduler)
+
+        self.pipeline = Pipeline([
+            Stage("fetch", partial(fetch_stage, self.fetcher, manifests), workers=self.fetcher.workers),
+            Stage("decode", partial(decode_stage, self.dedup), workers=DECODE_WORKERS),
+            *([] if defer_captions else [caption]),
+            Stage("insert", partial(insert_stage, self.writer), workers=INSERT_WORKERS),
+        ], on_error=self._skipped, on_drop=self._row_done)
+
+        # Captions of the objects inserted without one, a row is done once its caption is added
+        self.captioner = None
+        if defer_captions:
+            self.captioner = Pipeline([
+                caption,
+                Stage("update", partial(update_stage, self.collection), workers=UPDATE_WORKERS),
+            ], on_error=self._skipped, on_drop=self._row_done, on_done=self._row_done)
+
+    def start(self):
+        if self.captioner is not None:
+            self.captioner.start()
+        self.pipeline.start()
+        if self.spool is not None:
+            self.spool.start(self.pipeline.put)
+        return self
+
+    def feed(self, df):
+        '''
+        Feed all new rows of a window to the pipeline, blocks while the pipeline is full
+        '''
+        # Broker windows carry the checkpoint that acks their events
+        end = df.attrs["checkpoint"] if "checkpoint" in df.attrs else df.timestamp.max()
+
+        # Capture the window for offline replays
+        recorder.window(df)
+
+        # Only keep the nodes owned by this worker
+        if self.partition is not None:
+            df = self.partition.filter(df)
+
+        records = self._new_records(df)
+
+        # Track the window so the cursor only moves once all its rows are done
+        window = self.tracker.open(end, len(records)) if self.tracker is not None else None
+
+        if not records:
+            return
+
+        # Get the live location of all nodes in the window with one query
+        if self.locations is not None:
+            try:
+                self.locations.resolve({record["vsn"] for record in records if record["vsn"]})
+            except Exception as e:
+                logging.error(f"Failed to resolve live node locations, using manifest locations: {e}")
+
+        for record in records:
+            record["location"] = self.locations.get(record["vsn"]) if self.locations is not None and record["vsn"] else None
+            record["window"] = window
+            self.pipeline.put(record)
+
+    def close(self):
+        '''
+        Drain the pipeline and insert what is left
+        '''
+        if self.spool is not None:
+            self.spool.close()
+        self.pipeline.close()
+        self.writer.close()
+        if self.captioner is not None:
+            self.captioner.close()
+        self.fetcher.close()
+
+    def join(self):
+        '''
+        Wait until every row fed so far was inserted and captioned, or dropped
+        '''
+        self.pipeline.join()
+        self.writer.flush()
+        if self.captioner is not None:
+            self.captioner.join()
+
+    def stats(self):
+        '''
+        Stats of the stages of both pipelines
+        '''
+        stats = self.pipeline.stats()
+        if self.captioner is not None:
+            stats.update(self.captioner.stats())
+        return stats
+
+    def _new_records(self, df):
+        # Drop the rows that were already fed or indexed before they cost a download or a caption
+        records = []
+        if df.empty:
+            return records
+
+        for i in df.index:
+            record = row_to_record(df, i)
+            record["uuid"] = object_id(record["url"])
+            if self.recent_ids.add(record["uuid"]):
+                records.append(record)
+
+        try:
+            # Objects still without a caption, e.g. deferred before a restart, are loaded again
+            indexed = existing_ids(self.collection, [record["uuid"] for record in records], require="caption")
+        except Exception as e:
+            logging.error(f"Existence check failed, loading the whole window: {e}")
+            indexed = set()
+
+        skipped = len(df) - len(records) + len(indexed)
+        if skipped:
+            metrics.incr("rows_already_indexed", skipped)
+            logging.debug(f"Skipped {skipped} images that are already indexed")
+
+        return [record for record in records if record["uuid"] not in indexed]
+
+    def _skipped(self, stage, record, e):
+        log_skipped(stage, record, e)
+        if self.spool is not None and retryable(stage, e):
+            self.spool.add(record, stage, e)
+
+    def _shed(self, record):
+        # The camera has too many frames waiting for a caption, its oldest one waits in the spool
+        # without using up one of its attempts
+        logging.debug(f"Image shed from the caption queue of node {record['vsn']} for URL {record['url']}")
+        if self.spool is not None:
+            self.spool.add(record, "caption", "camera over its caption queue depth", attempt=False)
+        self._row_done(record)
+
+    def _row_done(self, record):
+        # A spooled row counts as done, the spool keeps it until it is inserted
+        if self.spool is not None:
+            self.spool.release(record)
+        if self.tracker is not None and record.get("window") is not None:
+            self.tracker.done(record["window"])
+
+    def _batch_done(self, objects, failed_objects):
+        failed = {str(failed.object_.uuid): failed.message for failed in failed_objects}
+        for obj in objects:
+            record = obj["ref"]
+            if str(obj["uuid"]) in failed:
+                if self.spool is not None:
+                    self.spool.add(record, "insert", failed[str(obj["uuid"])])
+                self._row_done(record)
+                continue
+
+            metrics.observe("freshness_searchable", record_age(record))
+            # Later frames of the camera are only compared with frames that are in the index
+            if self.dedup is not None and record.get("dhash") is not None:
+                self.dedup.add(record["vsn"], record["camera"], record["dhash"], record["uuid"])
+            if self.captioner is not None and record.get("caption") is None:
+                # Searchable by its image vector now, blocks while the captioner is full
+                self.captioner.put(record)
+            else:
+                self._row_done(record)
+
+class SageSource(Source):
+    '''
+    Polls the data API, after a restart it first catches up from the cursor
+    '''
+    def __init__(self, filter=None, partition=None):
+        self.filter = filter
+        self.partition = partition
+        self._cursor = None
+
+    def cursor(self):
+        # The cursor is committed once every row up to it was inserted
+        if self.partition is not None and self.partition.worker_count > 1:
+            self._cursor = ShardCursor(self.partition.worker_index, self.partition.worker_count)
+        else:
+            self._cursor = Cursor()
+        return self._cursor
+
+    def windows(self):
+        # Catch up on the images published while the loader was down
+        now = pd.Timestamp.utcnow()
+        resume_from = self._cursor.load() if self._cursor is not None else None
+        if resume_from is not None and resume_from < now:
+            logging.debug(f"Catching up from {resume_from} to {now}")
+            yield from catch_up(resume_from, now, filter=self.filter)
+
+        # Watch for data in real-time
+        yield from watch(start=now, filter=self.filter)
+
+def open_source(filter=None, partition=None):
+    '''
+    The source set by SOURCE, or Sage through the broker when BROKER_URL is set, or the data API
+    '''
+    if SOURCE:
+        return open_archive_source(SOURCE)
+    if BROKER_URL:
+        # Every worker has its own queue with all events and keeps the nodes of its partition
+        sharded = partition is not None and partition.worker_count > 1
+        return BrokerSource(queue=f"{BROKER_QUEUE}-{partition.worker_index}" if sharded else BROKER_QUEUE, filter=filter)
+    return SageSource(filter, partition)
+
+def continual_load(username, token, weaviate_client, triton_client, partition=None):
+    '''
+    Continously Load data to weaviate, a sharded worker only loads the nodes of its partition
     '''
 
     # Retrieve the Sage configuration
@@ -53,99 +541,78 @@ def continual_load(username, token, weaviate_client, triton_client):
         "plugin": "registry.sagecontinuum.org/yonghokim/imagesampler.*"
     }
 
-    # Watch for data in real-time
-    for df in watch(start=None, filter=filter):
+    # Where new images come from, Sage unless an archive or a broker is configured
+    source = open_source(filter, partition)
 
-        for i in df.index:
-            url = df.value[i]
-            timestamp = df.timestamp[i]
-            vsn = df["meta.vsn"][i]
-            filename = df["meta.filename"][i]
-            camera = df["meta.camera"][i]
-            host = df["meta.host"][i]
-            job = df["meta.job"][i]
-            node = df["meta.node"][i]
-            plugin = df["meta.plugin"][i]
-            task = df["meta.task"][i]
-            zone = df["meta.zone"][i]
+    # Start the ingestion pipeline
+    loader = Loader(auth, weaviate_client, triton_client, source.cursor(), partition, source=source).start()
 
-            try:
-                # Get the image data
-                response = requests.get(url, auth=auth)
-                response.raise_for_status()  # Raise error for bad responses
-                image_data = response.content
-
-                # Check if the response contains valid image data
-                if not image_data:
-                    logging.debug(f"Image skipped, empty content received for URL: {url}")
-                    continue
-
-                # Wrap the BytesIO stream in BufferedReader
-                image_stream = BytesIO(image_data)
-                buffered_stream = BufferedReader(image_stream)
-
-                #Reset the pointer to the beginning
-                image_stream.seek(0)  
-
-                # Encode the image
-                encoded_image = weaviate.util.image_encoder_b64(buffered_stream)
-
-                # Reset the pointer to the beginning, to be used again
-                image_stream.seek(0)  
-                image = Image.open(image_stream).convert("RGB")
-
-                # Get the manifest
-                response = requests.get(urljoin(MANIFEST_API, vsn.upper()))
-                response.raise_for_status()  # Raise error for bad responses
-                manifest = response.json()
-
-                # Extract fields from manifest
-                project = manifest.get('project', '')
-                address = manifest.get('address', '')
-                lat = manifest.get('gps_lat', '')
-                lon = manifest.get('gps_lon', '')
-
-                # Get live lat & lon
-                loc_df = sage_data_client.query(start="-5m", filter={"vsn": vsn.upper(), "name": "sys.gps.lat|sys.gps.lon"}, tail=1)
-                if not loc_df.empty:
-                    # Extract
-                    lat = loc_df[loc_df['name'] == 'sys.gps.lat']['value'].values[0]
-                    lon = loc_df[loc_df['name'] == 'sys.gps.lon']['value'].values[0]
-
-                # Generate caption
-                caption = triton_gen_caption(triton_client, image)
-
-                # Get Weaviate collection
-                collection = weaviate_client.collections.get("HybridSearchExample")
-
-                # Prepare data for insertion into Weaviate
-                data_properties = {
-                    "filename": filename,
-                    "image": encoded_image,
-                    "timestamp": timestamp.strftime('%y-%m-%d %H:%M Z'),
-                    "link": url,
-                    "caption": caption,
-                    "camera": camera,
-                    "host": host,
-                    "job": job,
-                    "node": node,
-                    "plugin": plugin,
-                    "task": task,
-                    "vsn": vsn,
-                    "zone": zone,
-                    "project": project,
-                    "address": address,
-                    "location": GeoCoordinate(latitude=float(lat), longitude=float(lon)),
-                }
-
-                collection.data.insert(properties=data_properties)
-                logging.debug(f'Image added: {url}')
-
-            except requests.exceptions.HTTPError as e:
-                logging.debug(f"Image skipped, HTTPError for URL {url}: {e}")
-            except requests.exceptions.RequestException as e:
-                logging.debug(f"Image skipped, request failed for URL {url}: {e}")
-            except Exception as e:
-                logging.debug(f"Image skipped, an error occurred for URL {url}: {e}")
+    for df in source.windows():
+        loader.feed(df)
+        logging.debug(f"Pipeline stages: {loader.stats()}")
+
+    loader.close()
+    source.close()
+
+    logging.debug("Images and Captions added to Weaviate")
+
+def to_timestamp(value, now):
+    '''
+    Absolute UTC timestamp of a time given like sage_data_client takes it, e.g. "2024-06-01T00:00:00Z" or "-14d"
+    '''
+    if isinstance(value, str) and value.startswith("-"):
+        return now - pd.Timedelta(value[1:])
+    timestamp = pd.Timestamp(value)
+    return timestamp.tz_localize("UTC") if timestamp.tzinfo is None else timestamp.tz_convert("UTC")
+
+def backfill(username, token, weaviate_client, triton_client, start, end=None, partition=None):
+    '''
+    Load the images published between start and end, e.g. to fill a new weaviate cluster.
+    The range is queried in windows with bounded parallelism and goes through the same
+    pipeline as continual_load, the checkpoint is committed as windows complete.
+    '''
+    auth = (username, token)
+
+    # Same images as continual_load
+    filter = {
+        "plugin": "registry.sagecontinuum.org/yonghokim/imagesampler.*"
+    }
+
+    now = pd.Timestamp.utcnow()
+    start = to_timestamp(start, now)
+    end = to_timestamp(end, now) if end else now
+
+    # The checkpoint is resumed by a backfill of the same range only
+    sharded = partition is not None and partition.worker_count > 1
+    cursor = BackfillCursor(start, end, partition.worker_index if sharded else None)
+
+    # The backfill spools apart from the live loader, which may run next to it
+    spool_dir = os.path.join(SPOOL_DIR, "backfill") if SPOOL_DIR else ""
+    loader = Loader(auth, weaviate_client, triton_client, cursor, partition, spool_dir).start()
+
+    resume_from = cursor.load()
+    if resume_from is not None:
+        logging.debug(f"Resuming backfill from checkpoint {resume_from}")
+        start = max(start, resume_from)
+
+    logging.debug(f"Backfilling from {start} to {end} in windows of {BACKFILL_WINDOW}")
+    if start < end:
+        for df in catch_up(start, end, filter=filter, window=BACKFILL_WINDOW, workers=BACKFILL_WORKERS):
+            loader.feed(df)
+
+    # Give the images that failed on a transient error their retries before finishing,
+    # an image with a long backoff can not hold up a finished backfill
+    loader.join()
+    deadline = time.monotonic() + BACKFILL_SPOOL_WAIT
+    while loader.spool is not None and loader.spool.pending():
+        if time.monotonic() >= deadline:
+            logging.error(f"{loader.spool.pending()} spooled images are left in {spool_dir} for the next backfill")
+            break
+        logging.debug(f"Waiting for {loader.spool.pending()} spooled images to be retried")
+        time.sleep(SPOOL_RETRY_INTERVAL)
+
+    loader.close()
 
-    logging.debug("Images and Captions added to Weaviate")
\ No newline at end of file
+    # Every window was loaded, including the empty ones at the end
+    cursor.commit(end)
+    logging.debug(f"Backfill from {start} to {end} done")
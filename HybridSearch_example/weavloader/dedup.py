@@ -0,0 +1,87 @@
+'''This file contains the near-duplicate filter for static cameras.
+Sage cameras point at the same scene all day, so consecutive frames are often
+nearly identical. Frames whose perceptual hash is close to a recent frame of
+the same camera are skipped before they cost a caption and an embedding.
+A frame only counts as seen once its object was inserted, so a frame that
+fails and is retried never suppresses the ones after it.'''
+
+import os
+import logging
+import threading
+from collections import deque
+from PIL import Image
+from metrics import metrics
+
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "false").lower() == "true" # Skip near-duplicate frames, they are left out of the index
+DEDUP_THRESHOLD = int(os.environ.get("DEDUP_THRESHOLD", 4)) # Max Hamming distance (of 64 bits) to count as duplicate
+DEDUP_HISTORY = int(os.environ.get("DEDUP_HISTORY", 16)) # Recent hashes kept per (vsn, camera)
+
+def dhash(image, hash_size=8):
+    '''
+    64 bit difference hash of a PIL image, robust to small changes in light and noise
+    '''
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = small.tobytes()
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class NearDuplicateFilter:
+    '''
+    Keeps a compact ring of the hashes of recently inserted frames per (vsn, camera)
+    '''
+    def __init__(self, threshold=DEDUP_THRESHOLD, history=DEDUP_HISTORY):
+        self.threshold = threshold
+        self.history = history
+        self.checked = 0
+        self.suppressed = 0
+        self._recent = {} # (vsn, camera) -> deque of (hash, uuid)
+        self._lock = threading.Lock()
+
+    def check(self, vsn, camera, image_hash):
+        '''
+        Get the uuid of the inserted frame this one duplicates, or None
+        '''
+        with self._lock:
+            self.checked += 1
+            for earlier_hash, earlier_uuid in self._recent.get((vsn, camera), ()):
+                if hamming(image_hash, earlier_hash) <= self.threshold:
+                    self.suppressed += 1
+                    self._report()
+                    return earlier_uuid
+
+            self._report()
+            return None
+
+    def add(self, vsn, camera, image_hash, uuid):
+        '''
+        Remember the frame once its object was inserted
+        '''
+        with self._lock:
+            self._recent.setdefault((vsn, camera), deque(maxlen=self.history)).append((image_hash, uuid))
+
+    def _report(self):
+        metrics.set_gauge("dedup_suppression_rate", self.suppressed / self.checked)
+        metrics.set_gauge("dedup_suppressed", self.suppressed)
+
+def suppress_duplicate(dedup, record, image):
+    '''
+    True if the frame is a near duplicate of a recent frame of the same camera, otherwise
+    its hash is kept in the record until the object is inserted
+    '''
+    image_hash = dhash(image)
+    earlier_uuid = dedup.check(record["vsn"], record["camera"], image_hash)
+    if earlier_uuid is None:
+        record["dhash"] = image_hash
+        return False
+
+    metrics.incr("frames_suppressed")
+    logging.debug(f"Image skipped, near duplicate of object {earlier_uuid} for URL: {record['url']}")
+    return True
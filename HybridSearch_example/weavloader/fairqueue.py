@@ -0,0 +1,242 @@
+'''This file contains the fair queue placed in front of the caption stage.
+Frames are queued per node (VSN) and camera and served with weighted fair
+queuing, so a node uploading at a high rate can not starve the quiet ones.
+Within a camera the freshest frame goes first, and nodes can be capped to a
+max caption rate. A full queue only blocks the nodes holding their share of
+it, so a capped or busy node can not block the quiet ones; optionally a camera
+only holds a few frames and its oldest frame is shed to the caller, e.g. to
+the spool.'''
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from metrics import metrics
+
+FAIR_QUEUE = os.environ.get("FAIR_QUEUE", "true").lower() == "true" # Schedule the caption stage fairly across nodes instead of first in first out
+FAIR_QUEUE_SIZE = int(os.environ.get("FAIR_QUEUE_SIZE", 64)) # Frames waiting for a caption before nodes over their weighted share of it block
+FAIR_FLOW_DEPTH = int(os.environ.get("FAIR_FLOW_DEPTH", 0)) # Max frames waiting per camera, the oldest is shed when a new one arrives, 0 never sheds
+FAIR_WEIGHTS = os.environ.get("FAIR_WEIGHTS", "") # Share of a node relative to the others, e.g. "W023=2,W0A1=0.5", default 1
+FAIR_RATE_CAP = float(os.environ.get("FAIR_RATE_CAP", 0)) # Max frames per second captioned per node, 0 is unlimited
+FAIR_RATE_CAPS = os.environ.get("FAIR_RATE_CAPS", "") # Per node rate caps overriding FAIR_RATE_CAP, e.g. "W023=0.2"
+
+def parse_node_values(value):
+    '''
+    Parse "VSN=number,..." into {VSN: number}
+    '''
+    values = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        vsn, _, number = part.partition("=")
+        values[vsn.strip().upper()] = float(number)
+    return values
+
+class _Flow:
+    '''
+    Frames of one camera
+    '''
+    def __init__(self):
+        self.items = []
+        self.vtime = 0.0
+
+class _Node:
+    '''
+    Cameras, virtual time and rate cap of one node
+    '''
+    def __init__(self, weight, rate_cap):
+        self.weight = weight
+        self.rate_cap = rate_cap
+        self.vtime = 0.0
+        self.clock = 0.0 # virtual time of the last camera served
+        self.depth = 0
+        self.flows = {}
+        self.tokens = max(1.0, rate_cap)
+        self.refilled = time.monotonic()
+
+    def refill(self, now):
+        if self.rate_cap > 0:
+            self.tokens = min(max(1.0, self.rate_cap), self.tokens + (now - self.refilled) * self.rate_cap)
+        self.refilled = now
+
+    def ready(self, now):
+        self.refill(now)
+        return self.rate_cap <= 0 or self.tokens >= 1.0
+
+    def ready_in(self):
+        return (1.0 - self.tokens) / self.rate_cap
+
+def _newest(flow):
+    return max(range(len(flow.items)), key=lambda i: flow.items[i]["timestamp"])
+
+def _oldest(flow):
+    return min(range(len(flow.items)), key=lambda i: flow.items[i]["timestamp"])
+
+class FairQueue:
+    '''
+    Drop-in replacement of the FIFO queue of a pipeline stage (put, get, task_done, join, qsize).
+    Items without a "vsn" (e.g. the stop signal of the pipeline) are served first.
+    '''
+    def __init__(self, name, maxsize=FAIR_QUEUE_SIZE, flow_depth=FAIR_FLOW_DEPTH, weights=None,
+                 rate_cap=FAIR_RATE_CAP, rate_caps=None, on_shed=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.flow_depth = flow_depth
+        self.weights = weights if weights is not None else parse_node_values(FAIR_WEIGHTS)
+        self.rate_cap = rate_cap
+        self.rate_caps = rate_caps if rate_caps is not None else parse_node_values(FAIR_RATE_CAPS)
+        self.on_shed = on_shed # called with the oldest frame of a camera that is over its depth, if flow_depth > 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._control = deque()
+        self._nodes = {}
+        self._size = 0
+        self._unfinished = 0
+        self._vtime = 0.0
+
+    def put(self, item):
+        '''
+        Queue an item, blocks while the queue is full and the node holds its share of it,
+        unless shedding is on and the frame replaces an older frame of the same camera
+        '''
+        shed = None
+        with self._not_full:
+            if not isinstance(item, dict) or "vsn" not in item:
+                self._control.append(item)
+                self._unfinished += 1
+                self._not_empty.notify()
+                return
+
+            vsn = str(item["vsn"]).upper()
+            while True:
+                node = self._node(vsn)
+                flow = node.flows.setdefault(item.get("camera"), _Flow())
+                if self.flow_depth > 0 and len(flow.items) >= self.flow_depth:
+                    # The new frame replaces the oldest one of the camera, the size stays the same
+                    shed = flow.items.pop(_oldest(flow))
+                    node.depth -= 1
+                    self._size -= 1
+                    self._unfinished -= 1
+                    break
+                if not self._full(node):
+                    break
+                self._not_full.wait()
+
+            # Idle nodes and cameras start at the current virtual time instead of catching up
+            if node.depth == 0:
+                node.vtime = max(node.vtime, self._vtime)
+            if not flow.items:
+                flow.vtime = max(flow.vtime, node.clock)
+
+            flow.items.append(item)
+            node.depth += 1
+            self._size += 1
+            self._unfinished += 1
+            self._report(vsn, node)
+            self._not_empty.notify()
+
+        if shed is not None:
+            metrics.incr(f"{self.name}_queue_shed")
+            self._shed(shed)
+
+    def get(self):
+        '''
+        Take the freshest frame of the camera and node that are the most behind their share
+        '''
+        with self._not_empty:
+            while True:
+                if self._control:
+                    return self._control.popleft()
+
+                item, wait = self._select(time.monotonic())
+                if item is not None:
+                    # Producers of every node wait on their own share, let them all check it
+                    self._not_full.notify_all()
+                    return item
+
+                # Nothing queued, or every node with frames is at its rate cap
+                self._not_empty.wait(wait)
+
+    def task_done(self):
+        with self._all_done:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self):
+        with self._all_done:
+            while self._unfinished > 0:
+                self._all_done.wait()
+
+    def qsize(self):
+        with self._lock:
+            return self._size + len(self._control)
+
+    def depths(self):
+        '''
+        Frames waiting per node
+        '''
+        with self._lock:
+            return {vsn: node.depth for vsn, node in self._nodes.items() if node.depth}
+
+    def _node(self, vsn):
+        node = self._nodes.get(vsn)
+        if node is None:
+            node = _Node(self.weights.get(vsn, 1.0), self.rate_caps.get(vsn, self.rate_cap))
+            self._nodes[vsn] = node
+        return node
+
+    def _full(self, node):
+        # Nodes under their weighted share of the queue get in even when it is full, so the
+        # queue holds at most twice its size and a capped node only blocks its own producers
+        if self.maxsize <= 0 or self._size < self.maxsize:
+            return False
+        weights = sum(n.weight for n in self._nodes.values() if n.depth or n is node)
+        return node.depth >= self.maxsize * node.weight / weights
+
+    def _select(self, now):
+        # Returns (item, None) or (None, seconds to wait before a capped node is ready)
+        best, wait = None, None
+        for vsn, node in self._nodes.items():
+            if node.depth == 0:
+                continue
+            if not node.ready(now):
+                ready_in = node.ready_in()
+                wait = ready_in if wait is None else min(wait, ready_in)
+                continue
+            if best is None or node.vtime < best[1].vtime:
+                best = (vsn, node)
+
+        if best is None:
+            return None, wait
+
+        vsn, node = best
+        flow = min((flow for flow in node.flows.values() if flow.items), key=lambda flow: flow.vtime)
+        item = flow.items.pop(_newest(flow))
+
+        # Advance the virtual times by the cost of one frame, weighted by the share of the node
+        self._vtime = node.vtime
+        node.vtime += 1.0 / node.weight
+        node.clock = flow.vtime
+        flow.vtime += 1.0
+        node.depth -= 1
+        if node.rate_cap > 0:
+            node.tokens -= 1.0
+        self._size -= 1
+        self._report(vsn, node)
+        return item, None
+
+    def _report(self, vsn, node):
+        metrics.set_gauge(f"{self.name}_queue_depth_{vsn}", node.depth)
+
+    def _shed(self, item):
+        if self.on_shed is None:
+            logging.debug(f"Image shed from the {self.name} queue for URL {item.get('url')}")
+            return
+        try:
+            self.on_shed(item)
+        except Exception as e:
+            logging.error(f"Shed handler failed for the {self.name} queue: {e}")
@@ -0,0 +1,55 @@
+'''This file contains the code to download images from Sage concurrently'''
+
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from recorder import recorder
+
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 8)) # Max number of images downloaded at the same time
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", 30)) # Seconds to wait for the image server
+FETCH_RETRIES = int(os.environ.get("FETCH_RETRIES", 2)) # Retries on connection errors & 5xx responses
+
+def create_session(auth=None, pool_size=FETCH_WORKERS, retries=FETCH_RETRIES):
+    '''
+    Create a requests session with a connection pool big enough for all fetch workers,
+    so connections are kept alive and reused between downloads
+    '''
+    session = requests.Session()
+    session.auth = auth
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+class ImageFetcher:
+    '''
+    Downloads images with bounded concurrency using a shared pooled session
+    '''
+    def __init__(self, auth=None, workers=FETCH_WORKERS, timeout=FETCH_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.session = create_session(auth, pool_size=workers)
+
+    def fetch(self, url):
+        '''
+        Download a single image and return its content
+        '''
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()  # Raise error for bad responses
+        recorder.image(url, response.content)
+        return response.content
+
+    def close(self):
+        '''
+        Release the pooled connections
+        '''
+        self.session.close()
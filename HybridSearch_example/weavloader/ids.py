@@ -0,0 +1,57 @@
+'''This file contains the code to give every image a deterministic object ID,
+so loading the same image twice never creates a duplicate in weaviate'''
+
+import os
+import threading
+from collections import OrderedDict
+from weaviate.util import generate_uuid5
+from weaviate.classes.query import Filter
+
+EXISTS_CHECK_BATCH = int(os.environ.get("EXISTS_CHECK_BATCH", 100)) # IDs looked up per existence query
+RECENT_IDS_SIZE = int(os.environ.get("RECENT_IDS_SIZE", 10000)) # IDs remembered to catch overlapping windows
+
+def object_id(link):
+    '''
+    Deterministic uuid5 of an image derived from its link
+    '''
+    return generate_uuid5(link)
+
+def existing_ids(collection, ids, batch_size=EXISTS_CHECK_BATCH, require=None):
+    '''
+    Get the subset of ids that are already indexed in the collection.
+    If require is set, objects where that property is still empty do not count.
+    '''
+    ids = list(ids)
+    found = set()
+    for i in range(0, len(ids), batch_size):
+        chunk = ids[i:i + batch_size]
+        res = collection.query.fetch_objects(
+            filters=Filter.by_id().contains_any(chunk),
+            limit=len(chunk),
+            return_properties=[require] if require else [],
+        )
+        found.update(str(obj.uuid) for obj in res.objects if not require or obj.properties.get(require))
+    return found
+
+class RecentIds:
+    '''
+    Bounded set of the IDs fed most recently, catches rows that are still in flight
+    and therefore not found by the existence check yet
+    '''
+    def __init__(self, max_size=RECENT_IDS_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, uuid):
+        '''
+        Remember an ID, returns False if it was already seen
+        '''
+        with self._lock:
+            if uuid in self._ids:
+                self._ids.move_to_end(uuid)
+                return False
+            self._ids[uuid] = None
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+            return True
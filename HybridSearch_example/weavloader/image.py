@@ -0,0 +1,140 @@
+'''This file contains the image object passed through the ingest pipeline.
+The raw bytes are held once, the base64 string is encoded straight from them
+and the pixels are decoded lazily at most once, then shared by every stage.
+Images can be downscaled at ingest time with separate target sizes for the
+caption input, the vectorizer blob and an optional stored thumbnail.'''
+
+import os
+import base64
+import threading
+import numpy as np
+from io import BytesIO
+from PIL import Image
+
+# Max size of the longest side in pixels, 0 keeps the original resolution
+CAPTION_MAX_SIZE = int(os.environ.get("CAPTION_MAX_SIZE", 768)) # Florence 2 resizes to 768 px on its side anyway
+VECTOR_MAX_SIZE = int(os.environ.get("VECTOR_MAX_SIZE", 512)) # Blob vectorized by ImageBind, which works on 224 px
+THUMBNAIL_MAX_SIZE = int(os.environ.get("THUMBNAIL_MAX_SIZE", 0)) # Optional stored thumbnail, 0 disables it
+RESIZE_JPEG_QUALITY = int(os.environ.get("RESIZE_JPEG_QUALITY", 85)) # Quality of the downscaled blobs
+
+def min_decode_size(*sizes):
+    '''
+    Smallest decode size that still serves every target, 0 when one of them needs the original
+    '''
+    sizes = [size for size in sizes if size is not None]
+    if not sizes or 0 in sizes:
+        return 0
+    return max(sizes)
+
+class IngestImage:
+    '''
+    An image downloaded for ingestion
+    '''
+    def __init__(self, data, caption_size=CAPTION_MAX_SIZE, decode_size=None):
+        self.data = data
+        self.caption_size = caption_size
+        if decode_size is None:
+            decode_size = min_decode_size(caption_size, VECTOR_MAX_SIZE, THUMBNAIL_MAX_SIZE or None)
+        self.decode_size = decode_size
+        self._original_size = None
+        self._pixels = None
+        self._resized = {}
+        self._tensor = None
+        self._caption_bytes = None
+        self._lock = threading.Lock()
+
+    def b64(self):
+        '''
+        Base64 string of the raw bytes, as expected by weaviate BLOB properties
+        '''
+        return base64.b64encode(memoryview(self.data)).decode("utf-8")
+
+    def encode(self, max_size):
+        '''
+        Base64 JPEG of the image downscaled to max_size, the raw bytes when no resize is needed
+        '''
+        self.pixels()
+        if not max_size or max(self._original_size) <= max_size:
+            return self.b64()
+
+        return base64.b64encode(self._jpeg(max_size)).decode("utf-8")
+
+    def caption_bytes(self):
+        '''
+        Encoded caption input for Florence 2, a JPEG of the downscaled image computed once,
+        the raw bytes when no resize is needed
+        '''
+        if not self.caption_size:
+            return self.data
+        self.pixels()
+        if max(self._original_size) <= self.caption_size:
+            return self.data
+
+        if self._caption_bytes is None:
+            data = self._jpeg(self.caption_size)
+            with self._lock:
+                self._caption_bytes = data
+        return self._caption_bytes
+
+    def pixels(self):
+        '''
+        Decoded RGB image, decoded on first use only
+        '''
+        with self._lock:
+            if self._pixels is None:
+                # BytesIO shares the bytes buffer until it is written to, so this does not copy
+                image = Image.open(BytesIO(self.data))
+                self._original_size = image.size
+
+                # Let the JPEG decoder downscale while decoding, much faster than decoding everything
+                if self.decode_size:
+                    image.draft("RGB", (self.decode_size, self.decode_size))
+                self._pixels = image.convert("RGB")
+            return self._pixels
+
+    def resized(self, max_size):
+        '''
+        The image with its longest side at most max_size, computed once per size
+        '''
+        pixels = self.pixels()
+        if not max_size or max(pixels.size) <= max_size:
+            return pixels
+
+        with self._lock:
+            if max_size not in self._resized:
+                image = pixels.copy()
+                image.thumbnail((max_size, max_size), Image.BILINEAR, reducing_gap=2.0)
+                self._resized[max_size] = image
+            return self._resized[max_size]
+
+    def tensor(self):
+        '''
+        [H, W, 3] FP32 array of the caption input for Florence 2, converted on first use only
+        '''
+        image = self.resized(self.caption_size)
+        with self._lock:
+            if self._tensor is None:
+                self._tensor = np.asarray(image, dtype=np.float32)
+            return self._tensor
+
+    def _jpeg(self, max_size):
+        stream = BytesIO()
+        self.resized(max_size).save(stream, format="JPEG", quality=RESIZE_JPEG_QUALITY)
+        return stream.getvalue()
+
+    @property
+    def size(self):
+        '''
+        (width, height) of the caption input
+        '''
+        return self.resized(self.caption_size).size
+
+    def release(self):
+        '''
+        Drop the decoded buffers once no stage needs the pixels anymore
+        '''
+        with self._lock:
+            self._pixels = None
+            self._resized = {}
+            self._tensor = None
+            self._caption_bytes = None
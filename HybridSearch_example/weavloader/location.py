@@ -0,0 +1,68 @@
+'''This file contains the code to resolve the live location of Sage nodes'''
+
+import os
+import time
+import logging
+import threading
+import sage_data_client
+from metrics import metrics
+from recorder import recorder
+
+LOCATION_FRESHNESS = float(os.environ.get("LOCATION_FRESHNESS", 300)) # Seconds a GPS fix is used before it is queried again
+LOCATION_LOOKBACK = os.environ.get("LOCATION_LOOKBACK", "-5m") # How far back to look for a GPS fix
+
+class LocationResolver:
+    '''
+    Keeps the latest GPS fix per node, fetching all nodes of a window in one bulk query
+    '''
+    def __init__(self, freshness=LOCATION_FRESHNESS, lookback=LOCATION_LOOKBACK):
+        self.freshness = freshness
+        self.lookback = lookback
+        self._fixes = {} # vsn -> (fetched_at, (lat, lon) or None if the node has no fix)
+        self._lock = threading.Lock()
+
+    def resolve(self, vsns):
+        '''
+        Refresh the fixes of all nodes that are missing or stale with a single query
+        '''
+        now = time.time()
+        with self._lock:
+            stale = sorted({
+                vsn.upper() for vsn in vsns
+                if vsn.upper() not in self._fixes or now - self._fixes[vsn.upper()][0] >= self.freshness
+            })
+
+        if not stale:
+            return
+
+        # the data API filters with regex, so all nodes are requested at once
+        with metrics.timer("location_query"):
+            loc_df = sage_data_client.query(
+                start=self.lookback,
+                filter={"vsn": "|".join(stale), "name": "sys.gps.lat|sys.gps.lon"},
+                tail=1,
+            )
+        metrics.incr("location_queries")
+        recorder.locations(loc_df)
+
+        fixes = {vsn: None for vsn in stale}
+        if not loc_df.empty:
+            # Keep the latest value of each series per node
+            latest = loc_df.sort_values("timestamp").groupby(["meta.vsn", "name"])["value"].last()
+            for vsn in stale:
+                try:
+                    fixes[vsn] = (latest[(vsn, "sys.gps.lat")], latest[(vsn, "sys.gps.lon")])
+                except KeyError:
+                    logging.debug(f"No live GPS fix found for node {vsn}")
+
+        with self._lock:
+            for vsn, fix in fixes.items():
+                self._fixes[vsn] = (now, fix)
+
+    def get(self, vsn):
+        '''
+        Get the (lat, lon) of a node or None if it has no live fix
+        '''
+        with self._lock:
+            entry = self._fixes.get(vsn.upper())
+        return entry[1] if entry else None
@@ -7,15 +7,20 @@
 import logging
 import os
 import time
+import multiprocessing
 from client import initialize_weaviate_client
-import tritonclient.grpc as TritonClient
-from data import continual_load
+from triton_async import open_triton_client
+from data import continual_load, backfill
+from metrics import log_metrics, METRICS_INTERVAL
+from partition import Partition, WORKER_INDEX, WORKER_COUNT, LOADER_WORKERS
 from apscheduler.schedulers.background import BackgroundScheduler
 
 USER = os.environ.get("SAGE_USER")
 PASS = os.environ.get("SAGE_PASS")
+BACKFILL_START = os.environ.get("BACKFILL_START", "") # Set to run a backfill instead of the continual load, e.g. "2024-06-01T00:00:00Z" or "-14d"
+BACKFILL_END = os.environ.get("BACKFILL_END", "") # End of the backfill, "" for now
 
-def run_continual_load():
+def run_continual_load(worker_index=WORKER_INDEX):
     '''
     Run the continual loading function in the background
     '''
@@ -23,29 +28,54 @@ def run_continual_load():
     weaviate_client = initialize_weaviate_client()
 
     # Initiate Triton client
-    triton_client = TritonClient.InferenceServerClient(url="florence2:8001")
+    triton_client = open_triton_client()
+
+    # Each worker only loads the nodes of its own partition
+    partition = Partition(worker_index, WORKER_COUNT)
 
     # Start continual loading
-    continual_load(USER, PASS, weaviate_client, triton_client)
+    continual_load(USER, PASS, weaviate_client, triton_client, partition)
 
-if __name__ == "__main__":
+def run_backfill(worker_index=WORKER_INDEX):
+    '''
+    Load the images published between BACKFILL_START and BACKFILL_END
+    '''
+    #init weaviate client
+    weaviate_client = initialize_weaviate_client()
 
-    # Configure logging
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(asctime)s %(message)s",
-        datefmt="%Y/%m/%d %H:%M:%S",
-    )
+    # Initiate Triton client
+    triton_client = open_triton_client()
+
+    # Each worker only loads the nodes of its own partition
+    partition = Partition(worker_index, WORKER_COUNT)
+
+    # Load the range, returns once it is done
+    backfill(USER, PASS, weaviate_client, triton_client, BACKFILL_START, BACKFILL_END, partition)
+
+def run_worker(worker_index=WORKER_INDEX):
+    '''
+    Run a loader worker, every worker has its own clients and insert path
+    '''
+    logging.debug(f"Starting loader worker {worker_index + 1}/{WORKER_COUNT}")
 
     # Initialize the background scheduler
     scheduler = BackgroundScheduler()
 
-    # Schedule the continual_load function
-    scheduler.add_job(run_continual_load)
+    # Periodically log the loader metrics
+    scheduler.add_job(log_metrics, "interval", seconds=METRICS_INTERVAL)
+
+    # A backfill runs in the foreground and the worker exits once it is done
+    if BACKFILL_START:
+        scheduler.start()
+        try:
+            run_backfill(worker_index)
+        finally:
+            log_metrics()
+            scheduler.shutdown()
+        return
 
-    #NOTE: I can add parallel loading of images using the scheduler, I will need to restructure the code though
-    #   so that each job knows what section of images to handle
-    #scheduler.add_job(run_continual_load, max_instances=2)
+    # Schedule the continual_load function
+    scheduler.add_job(run_continual_load, args=[worker_index])
 
     # Start the scheduler to run jobs in the background
     scheduler.start()
@@ -56,4 +86,35 @@ if __name__ == "__main__":
             time.sleep(10)
     except (KeyboardInterrupt, SystemExit):
         # Handle any exceptions to gracefully shutdown the scheduler
-        scheduler.shutdown()
\ No newline at end of file
+        scheduler.shutdown()
+
+if __name__ == "__main__":
+
+    # Configure logging
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+    )
+
+    #NOTE: parallel loading is done by sharding the nodes, each worker owns a partition of the VSNs.
+    #   Workers can run as processes in this container (LOADER_WORKERS) or as replicas (WORKER_INDEX),
+    #   WORKER_COUNT is the total number of workers across all replicas.
+    if WORKER_INDEX < 0 or WORKER_INDEX + LOADER_WORKERS > WORKER_COUNT:
+        raise ValueError(f"Workers {WORKER_INDEX} to {WORKER_INDEX + LOADER_WORKERS - 1} are out of range for WORKER_COUNT={WORKER_COUNT}")
+
+    if LOADER_WORKERS == 1:
+        run_worker(WORKER_INDEX)
+    else:
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(WORKER_INDEX + i,), name=f"loader-{WORKER_INDEX + i}")
+            for i in range(LOADER_WORKERS)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except (KeyboardInterrupt, SystemExit):
+            for worker in workers:
+                worker.terminate()
@@ -0,0 +1,123 @@
+'''This file contains the cache used to look up Sage node manifests'''
+
+import os
+import json
+import time
+import logging
+import threading
+import requests
+from collections import OrderedDict
+from urllib.parse import urljoin
+from metrics import metrics
+from recorder import recorder
+
+MANIFEST_API = os.environ.get("MANIFEST_API")
+MANIFEST_TTL = float(os.environ.get("MANIFEST_TTL", 3600)) # Seconds a manifest is trusted before it is fetched again
+MANIFEST_CACHE_SIZE = int(os.environ.get("MANIFEST_CACHE_SIZE", 1024)) # Max number of nodes kept in the cache
+MANIFEST_SNAPSHOT = os.environ.get("MANIFEST_SNAPSHOT", "") # Optional file to persist the cache between restarts
+
+class ManifestCache:
+    '''
+    Manifest cache keyed by VSN with a TTL, LRU eviction and an optional on-disk snapshot
+    '''
+    def __init__(self, api=MANIFEST_API, ttl=MANIFEST_TTL, max_size=MANIFEST_CACHE_SIZE,
+                 snapshot_path=MANIFEST_SNAPSHOT, session=None):
+        self.api = api
+        self.ttl = ttl
+        self.max_size = max_size
+        self.snapshot_path = snapshot_path
+        self.session = session or requests.Session()
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # vsn -> (fetched_at, manifest)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._snapshot_lock = threading.Lock()
+        self._load_snapshot()
+
+    def get(self, vsn):
+        '''
+        Get the manifest of a node, only calling the manifest API on a miss or expired entry
+        '''
+        key = vsn.upper()
+
+        manifest = self._lookup(key)
+        if manifest is not None:
+            self._count_hit()
+            return manifest
+
+        # Only one thread fetches a given node, the others wait and then hit the cache
+        with self._key_lock(key):
+            manifest = self._lookup(key)
+            if manifest is not None:
+                self._count_hit()
+                return manifest
+
+            with self._lock:
+                self.misses += 1
+            metrics.incr("manifest_cache_misses")
+
+            response = self.session.get(urljoin(self.api, key))
+            response.raise_for_status()  # Raise error for bad responses
+            manifest = response.json()
+            recorder.manifest(key, manifest)
+
+            with self._lock:
+                self._entries[key] = (time.time(), manifest)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+            self._save_snapshot()
+            return manifest
+
+    def stats(self):
+        '''
+        Cache hit and miss counters, used to size the TTL
+        '''
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                return entry[1]
+            return None
+
+    def _count_hit(self):
+        with self._lock:
+            self.hits += 1
+        metrics.incr("manifest_cache_hits")
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            for key, (fetched_at, manifest) in sorted(snapshot.items(), key=lambda item: item[1][0]):
+                self._entries[key] = (fetched_at, manifest)
+            logging.debug(f"Loaded {len(self._entries)} manifests from {self.snapshot_path}")
+        except Exception as e:
+            logging.error(f"Failed to load manifest snapshot {self.snapshot_path}: {e}")
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            snapshot = {key: list(entry) for key, entry in self._entries.items()}
+        try:
+            # Write to a temp file first so a crash never leaves a half written snapshot
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with self._snapshot_lock:
+                with open(tmp_path, "w") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp_path, self.snapshot_path)
+        except Exception as e:
+            logging.error(f"Failed to save manifest snapshot {self.snapshot_path}: {e}")
@@ -0,0 +1,90 @@
+'''This file contains simple in-process metrics used to tune the loader'''
+
+import os
+import time
+import logging
+import threading
+
+METRICS_INTERVAL = int(os.environ.get("METRICS_INTERVAL", 60)) # Seconds between metric log lines
+
+class Metrics:
+    '''
+    Thread safe registry of counters, gauges and timings
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def incr(self, name, value=1):
+        '''
+        Increase a counter
+        '''
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        '''
+        Set a gauge to its current value
+        '''
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        '''
+        Record a duration in seconds
+        '''
+        with self._lock:
+            count, total, worst = self._timings.get(name, (0, 0.0, 0.0))
+            self._timings[name] = (count + 1, total + seconds, max(worst, seconds))
+
+    def timer(self, name):
+        '''
+        Context manager that records how long the block took
+        '''
+        return _Timer(self, name)
+
+    def counter(self, name):
+        '''
+        Get the current value of a counter
+        '''
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        '''
+        Get a copy of all metrics, timings are reported as count, avg and max
+        '''
+        with self._lock:
+            timings = {
+                name: {"count": count, "avg": total / count if count else 0.0, "max": worst}
+                for name, (count, total, worst) in self._timings.items()
+            }
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": timings,
+            }
+
+class _Timer:
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+# Registry shared by the whole loader
+metrics = Metrics()
+
+def log_metrics():
+    '''
+    Log a snapshot of the loader metrics
+    '''
+    logging.debug(f"Loader metrics: {metrics.snapshot()}")
@@ -1,81 +1,297 @@
 '''This file contains the code to talk to Florence 2 model'''
 
+import os
+import asyncio
 import logging
 from collections import OrderedDict
 from PIL import Image
 import tritonclient.grpc as TritonClient
 import numpy as np
 import json
+from concurrent.futures import Future
+from tritonclient.utils import serialize_byte_tensor, serialized_byte_size
+from pipeline import then
+from shm_pool import region_pool
 
-def triton_run_model(triton_client, task_prompt, image, text_input=""):
+TRITON_IMAGE_TRANSPORT = os.environ.get("TRITON_IMAGE_TRANSPORT", "bytes") # "bytes" sends the encoded image, decoded by Florence 2, "tensor" sends the decoded FP32 caption input
+TRITON_FUSED = os.environ.get("TRITON_FUSED", "true").lower() == "true" # Run the caption tasks in one request to florence2multi, false sends one request per task to florence2base
+
+# Tasks of a caption and the task whose answer is their text input, the grounding task is
+# chained off the detailed caption while the dense region caption runs next to them
+CAPTION_GRAPH = {
+    '<MORE_DETAILED_CAPTION>': None,
+    '<CAPTION_TO_PHRASE_GROUNDING>': '<MORE_DETAILED_CAPTION>',
+    '<DENSE_REGION_CAPTION>': None,
+}
+CAPTION_TASKS = list(CAPTION_GRAPH)
+
+def image_tensor(image):
     """
-    takes in a task prompt and image, returns an answer 
+    FP32 [H, W, 3] tensor of an IngestImage (converted once and reused) or a PIL image
+    """
+    if hasattr(image, "tensor"):
+        return image.tensor()
+    return np.asarray(image, dtype=np.float32)
+
+def image_inputs(image, transport=None):
+    """
+    Triton inputs of the image, the encoded caption input or the FP32 tensor and its size
     """
-    # Prepare inputs for Triton
+    transport = transport or TRITON_IMAGE_TRANSPORT
+
+    # The encoded caption input is a fraction of the FP32 tensor, Florence 2 decodes it itself
+    if transport == "bytes" and hasattr(image, "caption_bytes"):
+        inputs = [TritonClient.InferInput("image_bytes", [1], "BYTES")]
+        inputs[0].set_data_from_numpy(np.array([bytes(image.caption_bytes())], dtype="object"))
+        return inputs
+
     image_width, image_height = image.size
-    image_np = np.array(image).astype(np.float32)
-    task_prompt_bytes = task_prompt.encode("utf-8")
-    text_input_bytes = text_input.encode("utf-8")
+    image_np = image_tensor(image)
 
-    # Prepare inputs & outputs for Triton
     # NOTE: if you enable max_batch_size, leading number is batch size, example [1,1] 1 is batch size
     inputs = [
         TritonClient.InferInput("image", [image_height, image_width, 3], "FP32"),
-        TritonClient.InferInput("prompt", [1], "BYTES"),
-        TritonClient.InferInput("text_input", [1], "BYTES"),
         TritonClient.InferInput("image_width", [1], "INT32"),
         TritonClient.InferInput("image_height", [1], "INT32")
     ]
+    inputs[0].set_data_from_numpy(image_np)
+    inputs[1].set_data_from_numpy(np.array([image_width], dtype="int32"))
+    inputs[2].set_data_from_numpy(np.array([image_height], dtype="int32"))
+    return inputs
+
+def shared_image_inputs(image, pool, transport=None):
+    """
+    image_inputs written into a shared memory region of the pool, returns (inputs, region) and the
+    region is held until it is released. Images that do not fit a region are sent over gRPC
+    """
+    transport = transport or TRITON_IMAGE_TRANSPORT
+
+    if transport == "bytes" and hasattr(image, "caption_bytes"):
+        image_bytes = serialize_byte_tensor(np.array([bytes(image.caption_bytes())], dtype="object"))
+        region = pool.acquire(serialized_byte_size(image_bytes))
+        if region is None:
+            return image_inputs(image, transport), None
+
+        inputs = [TritonClient.InferInput("image_bytes", [1], "BYTES")]
+        region.put(inputs[0], image_bytes)
+        return inputs, region
+
+    image_width, image_height = image.size
+    region = pool.acquire(image_height * image_width * 3 * np.dtype(np.float32).itemsize)
+    if region is None:
+        return image_inputs(image, transport), None
+
+    inputs = [
+        TritonClient.InferInput("image", [image_height, image_width, 3], "FP32"),
+        TritonClient.InferInput("image_width", [1], "INT32"),
+        TritonClient.InferInput("image_height", [1], "INT32")
+    ]
+    # The pixels are converted to FP32 right in the region, without an intermediate tensor
+    caption_image = image.resized(image.caption_size) if hasattr(image, "resized") else image
+    region.view(inputs[0], np.float32, [image_height, image_width, 3])[...] = np.asarray(caption_image)
+    inputs[1].set_data_from_numpy(np.array([image_width], dtype="int32"))
+    inputs[2].set_data_from_numpy(np.array([image_height], dtype="int32"))
+    return inputs, region
+
+def request_inputs(image):
+    """
+    Inputs of the image for its caption requests and the shared memory region to release
+    once they are done, None without the shared memory transport
+    """
+    pool = region_pool()
+    if pool is None:
+        return image_inputs(image), None
+    return shared_image_inputs(image, pool)
+
+def parse_answer(response):
+    """
+    answer of a response as a dictionary
+    """
+    # Get the result
+    answer = response.as_numpy("answer")[0]
+    answer_str = answer.decode("utf-8")
+
+    # Convert the JSON string to a dictionary
+    return json.loads(answer_str)
+
+def triton_infer(triton_client, model_name, inputs):
+    """
+    runs the model and returns its answer as a dictionary, None on errors
+    """
     outputs = [
         TritonClient.InferRequestedOutput("answer")
     ]
 
-    # Add tensors
-    inputs[0].set_data_from_numpy(image_np)
-    inputs[1].set_data_from_numpy(np.array([task_prompt_bytes], dtype="object"))
-    inputs[2].set_data_from_numpy(np.array([text_input_bytes], dtype="object"))
-    inputs[3].set_data_from_numpy(np.array([image_width], dtype="int32"))
-    inputs[4].set_data_from_numpy(np.array([image_height], dtype="int32"))
-
     # Perform inference
     try:
-        response = triton_client.infer(model_name="florence2base", inputs=inputs, outputs=outputs)
+        response = triton_client.infer(model_name=model_name, inputs=inputs, outputs=outputs)
+        return parse_answer(response)
+    except Exception as e:
+        logging.error(f"Error during inference: {str(e)}")
+        return None
 
-        # Get the result
-        answer = response.as_numpy("answer")[0]
-        answer_str = answer.decode("utf-8")
+async def triton_infer_async(triton, model_name, inputs):
+    """
+    triton_infer on an AsyncTriton, other requests keep going while this one waits
+    """
+    outputs = [
+        TritonClient.InferRequestedOutput("answer")
+    ]
+
+    try:
+        response = await triton.infer(model_name, inputs, outputs)
+        return parse_answer(response)
+    except Exception as e:
+        logging.error(f"Error during inference: {str(e)}")
+        return None
 
-        # Convert the JSON string to a dictionary
-        answer_dict = json.loads(answer_str)
+def prompt_inputs(task_prompt, text_input=""):
+    """
+    Triton inputs of a task prompt for florence2base
+    """
+    task_prompt_bytes = task_prompt.encode("utf-8")
+    text_input_bytes = text_input.encode("utf-8")
 
-        return answer_dict
+    inputs = [
+        TritonClient.InferInput("prompt", [1], "BYTES"),
+        TritonClient.InferInput("text_input", [1], "BYTES"),
+    ]
+    inputs[0].set_data_from_numpy(np.array([task_prompt_bytes], dtype="object"))
+    inputs[1].set_data_from_numpy(np.array([text_input_bytes], dtype="object"))
+    return inputs
+
+def tasks_inputs(tasks):
+    """
+    Triton inputs of a list of task prompts for florence2multi
+    """
+    inputs = [
+        TritonClient.InferInput("tasks", [len(tasks)], "BYTES"),
+    ]
+    inputs[0].set_data_from_numpy(np.array([task.encode("utf-8") for task in tasks], dtype="object"))
+    return inputs
+
+def triton_run_model(triton_client, task_prompt, image, text_input=""):
+    """
+    takes in a task prompt and image, returns an answer 
+    """
+    return triton_infer(triton_client, "florence2base", image_inputs(image) + prompt_inputs(task_prompt, text_input))
+
+def triton_run_tasks(triton_client, tasks, image):
+    """
+    takes in a list of task prompts and an image, returns the answers of all tasks from one
+    request to the fused model. The image is sent and encoded once, grounding tasks use the caption before them
+    """
+    return triton_infer(triton_client, "florence2multi", image_inputs(image) + tasks_inputs(tasks))
+
+def run_task_graph(triton_client, inputs, graph=CAPTION_GRAPH):
+    """
+    runs the tasks of the graph on florence2base, a task is sent as soon as the task it depends on
+    is answered, so independent tasks run at the same time. Returns the merged answers, None on errors
+    """
+    outputs = [
+        TritonClient.InferRequestedOutput("answer")
+    ]
+    answers = {task: Future() for task in graph}
+
+    def send(task, text_input=""):
+        try:
+            callback = lambda result, error: done(task, result, error)
+            triton_client.async_infer("florence2base", inputs + prompt_inputs(task, text_input), callback, outputs=outputs)
+        except Exception as e:
+            fail(task, e)
+
+    def done(task, result, error):
+        # Runs on the gRPC thread, it only sends the dependent tasks and never blocks
+        try:
+            if error is not None:
+                raise error
+            answer = parse_answer(result)[task]
+        except Exception as e:
+            fail(task, e)
+            return
+        answers[task].set_result(answer)
+        for dependent, dependency in graph.items():
+            if dependency == task:
+                send(dependent, answer)
+
+    def fail(task, e):
+        # Tasks depending on a failed task are never sent
+        answers[task].set_exception(e)
+        for dependent, dependency in graph.items():
+            if dependency == task:
+                fail(dependent, e)
+
+    for task, dependency in graph.items():
+        if dependency is None:
+            send(task)
+
+    try:
+        return {task: answer.result() for task, answer in answers.items()}
     except Exception as e:
         logging.error(f"Error during inference: {str(e)}")
         return None
 
-def triton_gen_caption(triton_client, image):
+async def run_task_graph_async(triton, inputs, graph=CAPTION_GRAPH):
     """
-    Generate image caption using the provided model
+    run_task_graph on an AsyncTriton
     """
-    task_prompt = '<MORE_DETAILED_CAPTION>'
+    outputs = [
+        TritonClient.InferRequestedOutput("answer")
+    ]
+    answers = {}
+
+    async def run(task):
+        dependency = graph[task]
+        text_input = ""
+        if dependency is not None:
+            text_input = await answers[dependency]
+        response = await triton.infer("florence2base", inputs + prompt_inputs(task, text_input), outputs)
+        return parse_answer(response)[task]
 
-    description_text = triton_run_model(triton_client, task_prompt, image)
-    description_text = description_text[task_prompt]
+    # Every task starts at once, a dependent task waits on its dependency inside run
+    for task in graph:
+        answers[task] = asyncio.ensure_future(run(task))
+    results = await asyncio.gather(*answers.values(), return_exceptions=True)
 
-    #takes those details from the setences and finds labels and boxes in the image
-    task_prompt = '<CAPTION_TO_PHRASE_GROUNDING>'
-    boxed_descriptions = triton_run_model(triton_client, task_prompt, image, description_text)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logging.error(f"Error during inference: {str(errors[0])}")
+        return None
+    return dict(zip(answers, results))
+
+def caption_answers(triton_client, image):
+    """
+    answers of the caption tasks, from one fused request or the task graph on florence2base
+    """
+    inputs, region = request_inputs(image)
+    try:
+        if TRITON_FUSED:
+            return triton_infer(triton_client, "florence2multi", inputs + tasks_inputs(CAPTION_TASKS))
+        return run_task_graph(triton_client, inputs)
+    finally:
+        if region is not None:
+            region_pool().release(region)
+
+async def caption_answers_async(triton, inputs):
+    """
+    caption_answers on an AsyncTriton, from the image inputs
+    """
+    if TRITON_FUSED:
+        return await triton_infer_async(triton, "florence2multi", inputs + tasks_inputs(CAPTION_TASKS))
+    return await run_task_graph_async(triton, inputs)
+
+def caption_text(answers):
+    """
+    Combine the answers of the caption tasks into the caption
+    """
+    description_text = answers['<MORE_DETAILED_CAPTION>']
 
     #only prints out labels not bboxes
-    descriptions = boxed_descriptions[task_prompt]['labels']
+    descriptions = answers['<CAPTION_TO_PHRASE_GROUNDING>']['labels']
     logging.debug(f'Labels Generated: {descriptions}')
 
-    #finds other things in the image that the description did not explicitly say
-    task_prompt = '<DENSE_REGION_CAPTION>'
-    labels = triton_run_model(triton_client, task_prompt, image)
-
     #only prints out labels not bboxes
-    printed_labels = labels[task_prompt]['labels']
+    printed_labels = answers['<DENSE_REGION_CAPTION>']['labels']
 
     # Join description_text into a single string
     description_text_joined = "".join(description_text)
@@ -92,4 +308,21 @@ def triton_gen_caption(triton_client, image):
     final_description = " ".join(combined_list)
 
     logging.debug(f'Final Generated Description: {final_description}')
-    return final_description
\ No newline at end of file
+    return final_description
+
+def triton_gen_caption(triton_client, image):
+    """
+    Generate image caption using the provided model
+    """
+    return caption_text(caption_answers(triton_client, image))
+
+def triton_gen_caption_async(triton, image):
+    """
+    Generate the image caption on an AsyncTriton, returns a future of the caption.
+    The image inputs are built in the calling thread, the event loop only waits on Triton
+    """
+    inputs, region = request_inputs(image)
+    answers = triton.submit(caption_answers_async(triton, inputs))
+    if region is not None:
+        answers.add_done_callback(lambda future: region_pool().release(region))
+    return then(answers, caption_text)
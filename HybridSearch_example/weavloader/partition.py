@@ -0,0 +1,61 @@
+'''This file contains the code to split the Sage nodes between loader workers.
+Every worker owns a consistent-hash partition of the VSNs, so adding or
+removing a worker only moves a small share of the nodes to another worker.'''
+
+import os
+import bisect
+import hashlib
+
+LOADER_WORKERS = int(os.environ.get("LOADER_WORKERS", 1)) # Worker processes started by this replica
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", LOADER_WORKERS)) # Total number of loader workers across all replicas, the workers of this replica by default
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", 0)) # Index of the first worker in this replica
+HASH_RING_REPLICAS = int(os.environ.get("HASH_RING_REPLICAS", 100)) # Virtual nodes per worker on the hash ring
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16)
+
+class HashRing:
+    '''
+    Consistent hash ring mapping keys to worker indexes
+    '''
+    def __init__(self, worker_count, replicas=HASH_RING_REPLICAS):
+        self.worker_count = worker_count
+        ring = sorted(
+            (_hash(f"worker-{worker}-{replica}"), worker)
+            for worker in range(worker_count)
+            for replica in range(replicas)
+        )
+        self._keys = [key for key, _ in ring]
+        self._workers = [worker for _, worker in ring]
+
+    def owner(self, key):
+        '''
+        Get the index of the worker that owns the key
+        '''
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._workers[i]
+
+class Partition:
+    '''
+    The VSNs owned by one worker
+    '''
+    def __init__(self, worker_index=WORKER_INDEX, worker_count=WORKER_COUNT):
+        if not 0 <= worker_index < worker_count:
+            raise ValueError(f"Worker index {worker_index} is out of range for {worker_count} workers")
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.ring = HashRing(worker_count)
+
+    def owns(self, vsn):
+        '''
+        Check if the node belongs to this worker
+        '''
+        return self.worker_count == 1 or self.ring.owner(vsn.upper()) == self.worker_index
+
+    def filter(self, df):
+        '''
+        Keep only the rows of the nodes owned by this worker
+        '''
+        if self.worker_count == 1 or df.empty:
+            return df
+        return df[df["meta.vsn"].map(self.owns)]
@@ -0,0 +1,229 @@
+'''This file contains a small staged pipeline used to ingest images.
+Every stage has its own bounded queue and worker pool, so a slow stage
+only needs more workers instead of stalling everything behind it. When a
+queue is full the stage before it blocks, which propagates the backpressure
+all the way up to the source. A stage can also return futures (e.g. for async
+inference), then its workers keep going while a bounded number of items are in
+flight and a completion thread forwards them once they are done.'''
+
+import os
+import time
+import queue
+import logging
+import threading
+from functools import partial
+from concurrent.futures import Future
+from metrics import metrics
+
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 32)) # Max items waiting in front of each stage
+
+_STOP = object()
+
+def then(future, func):
+    '''
+    Future of func applied to the result of the future, func runs in the thread that completes it
+    '''
+    chained = Future()
+
+    def done(future):
+        try:
+            chained.set_result(func(future.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+class Stage:
+    '''
+    A pipeline step, func takes an item and returns the item for the next stage
+    or None to drop it. A scheduler (e.g. a FairQueue) can replace the FIFO queue of the stage.
+    A stage with in_flight set may return a Future of that instead, its workers block once
+    in_flight items are pending.
+    '''
+    def __init__(self, name, func, workers=1, queue_size=PIPELINE_QUEUE_SIZE, scheduler=None, in_flight=0):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = scheduler if scheduler is not None else queue.Queue(maxsize=queue_size)
+        self.in_flight = in_flight
+        self.slots = threading.BoundedSemaphore(in_flight) if in_flight > 0 else None
+        self.completed = queue.Queue() # futures that are done, unbounded as the slots bound them
+        self.processed = 0
+        self.service_time = 0.0
+        self._lock = threading.Lock()
+        self._threads = []
+        self._completer = None
+
+    def record(self, seconds):
+        with self._lock:
+            self.processed += 1
+            self.service_time += seconds
+        metrics.observe(f"stage_{self.name}", seconds)
+
+    def stats(self):
+        '''
+        Queue depth and average service time of the stage
+        '''
+        with self._lock:
+            avg = self.service_time / self.processed if self.processed else 0.0
+            return {
+                "depth": self.queue.qsize(),
+                "workers": self.workers,
+                "processed": self.processed,
+                "avg_service_time": avg,
+            }
+
+class Pipeline:
+    '''
+    Chains stages with bounded queues and runs each stage with its own worker pool
+    '''
+    def __init__(self, stages, on_error=None, on_drop=None, on_done=None):
+        self.stages = stages
+        self.on_error = on_error # called with (stage name, item, exception) when a stage fails
+        self.on_drop = on_drop # called with the item when a stage fails or drops it
+        self.on_done = on_done # called with the item returned by the last stage
+
+    def start(self):
+        '''
+        Start the workers of all stages
+        '''
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage, next_stage),
+                    name=f"{stage.name}-{n}",
+                    daemon=True,
+                )
+                thread.start()
+                stage._threads.append(thread)
+
+            # Stages returning futures get a thread finishing the items once their future is done
+            if stage.slots is not None:
+                stage._completer = threading.Thread(
+                    target=self._complete,
+                    args=(stage, next_stage),
+                    name=f"{stage.name}-completer",
+                    daemon=True,
+                )
+                stage._completer.start()
+        return self
+
+    def put(self, item):
+        '''
+        Feed an item to the first stage, blocks while the pipeline is full
+        '''
+        self.stages[0].queue.put(item)
+
+    def join(self):
+        '''
+        Wait until every item fed so far went through all stages
+        '''
+        for stage in self.stages:
+            stage.queue.join()
+
+    def close(self):
+        '''
+        Drain the pipeline and stop the workers
+        '''
+        for stage in self.stages:
+            stage.queue.join()
+            for _ in stage._threads:
+                stage.queue.put(_STOP)
+            for thread in stage._threads:
+                thread.join()
+            if stage._completer is not None:
+                stage.completed.put(_STOP)
+                stage._completer.join()
+
+    def stats(self):
+        '''
+        Stats of every stage, the stage with the deepest queue is the bottleneck
+        '''
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def _work(self, stage, next_stage):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                stage.queue.task_done()
+                return
+
+            metrics.set_gauge(f"stage_{stage.name}_depth", stage.queue.qsize())
+
+            # Blocks while too many items of the stage are in flight
+            if stage.slots is not None:
+                stage.slots.acquire()
+
+            start = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                result = None
+                self._report_error(stage, item, e)
+
+            if isinstance(result, Future):
+                # The completion thread finishes the item, the worker takes the next one
+                result.add_done_callback(partial(self._completed, stage, item, start))
+                continue
+            self._finish(stage, next_stage, item, result, start)
+
+    def _completed(self, stage, item, start, future):
+        # Runs in the thread completing the future, which must not block on the next stage
+        stage.completed.put((item, future, start))
+
+    def _complete(self, stage, next_stage):
+        while True:
+            completed = stage.completed.get()
+            if completed is _STOP:
+                return
+
+            item, future, start = completed
+            try:
+                result = future.result()
+            except Exception as e:
+                result = None
+                self._report_error(stage, item, e)
+            self._finish(stage, next_stage, item, result, start)
+
+    def _finish(self, stage, next_stage, item, result, start):
+        stage.record(time.perf_counter() - start)
+        if result is None:
+            self._report_drop(stage, item)
+        elif next_stage is not None:
+            # Blocks while the next stage is full, this is the backpressure
+            next_stage.queue.put(result)
+        else:
+            self._report_done(stage, result)
+
+        # The slot is only freed once the item was handed on, so the completed futures stay bounded
+        if stage.slots is not None:
+            stage.slots.release()
+        stage.queue.task_done()
+
+    def _report_error(self, stage, item, e):
+        if self.on_error is None:
+            logging.error(f"Stage {stage.name} failed: {e}")
+            return
+        try:
+            self.on_error(stage.name, item, e)
+        except Exception as handler_error:
+            logging.error(f"Error handler failed for stage {stage.name}: {handler_error}")
+
+    def _report_drop(self, stage, item):
+        if self.on_drop is None:
+            return
+        try:
+            self.on_drop(item)
+        except Exception as handler_error:
+            logging.error(f"Drop handler failed for stage {stage.name}: {handler_error}")
+
+    def _report_done(self, stage, item):
+        if self.on_done is None:
+            return
+        try:
+            self.on_done(item)
+        except Exception as handler_error:
+            logging.error(f"Done handler failed for stage {stage.name}: {handler_error}")
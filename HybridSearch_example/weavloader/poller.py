@@ -0,0 +1,61 @@
+'''This file contains the adaptive polling schedule used by watch()'''
+
+import os
+import pandas as pd
+from metrics import metrics
+
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 3.0)) # Starting seconds between polls
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", 1.0)) # Fastest polling, used while windows are full
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", 60.0)) # Slowest polling, reached after empty windows
+POLL_BACKOFF = float(os.environ.get("POLL_BACKOFF", 2.0)) # Factor the interval grows by on every empty window
+POLL_FULL_ROWS = int(os.environ.get("POLL_FULL_ROWS", 100)) # Rows in a window that count as a burst
+POLL_MAX_SPAN = os.environ.get("POLL_MAX_SPAN", "5min") # Max time span requested by a single query
+POLL_INGEST_LAG = os.environ.get("POLL_INGEST_LAG", "2min") # Time rows may take to show up in the data API, a span is only skipped past once it is older
+
+class AdaptivePoller:
+    '''
+    Backs off exponentially on empty windows, speeds up when windows are full and
+    caps the time span of every query so one call never returns a huge DataFrame
+    '''
+    def __init__(self, interval=POLL_INTERVAL, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 backoff=POLL_BACKOFF, full_rows=POLL_FULL_ROWS, max_span=POLL_MAX_SPAN, ingest_lag=POLL_INGEST_LAG):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.full_rows = full_rows
+        self.max_span = pd.Timedelta(max_span)
+        self.ingest_lag = pd.Timedelta(ingest_lag)
+
+    def window_end(self, start, now):
+        '''
+        End of the next query, returns (end, capped) where capped means the loader is behind.
+        A span is only capped once it is older than the ingest lag, so no row can still show up in it.
+        '''
+        end = start + self.max_span
+        if end < now - self.ingest_lag:
+            return end, True
+        return now, False
+
+    def update(self, rows, latency, capped=False):
+        '''
+        Record a poll and get the seconds to sleep before the next one,
+        rows only counts the rows newer than the start of the query
+        '''
+        metrics.observe("poll_latency", latency)
+        metrics.incr("poll_rows", rows)
+        metrics.set_gauge("poll_rows_last", rows)
+
+        if rows == 0:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        elif rows >= self.full_rows:
+            self.interval = self.min_interval
+        else:
+            self.interval = max(self.interval / self.backoff, self.min_interval)
+
+        metrics.set_gauge("poll_interval", self.interval)
+
+        # Still behind, query the next span right away
+        if capped:
+            return 0.0
+        return self.interval
@@ -0,0 +1,88 @@
+'''This file contains the recorder that captures what the loader receives from
+Sage (watch() windows, image bytes, manifests and GPS results) into a local
+fixture directory. The fixtures are played back by benchmarks/replay.py to
+measure loader throughput without Sage, Triton or Weaviate.'''
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+RECORD_DIR = os.environ.get("RECORD_DIR", "") # Set to a directory to record fixtures, "" disables recording
+
+def url_key(url):
+    '''
+    File name of a recorded image
+    '''
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+class Recorder:
+    '''
+    Writes fixtures to a directory, every method is a no-op while recording is disabled
+    '''
+    def __init__(self, directory=RECORD_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._windows = 0
+        self._locations = 0
+        if directory:
+            for sub in ("windows", "images", "manifests", "locations"):
+                os.makedirs(os.path.join(directory, sub), exist_ok=True)
+            logging.debug(f"Recording loader fixtures to {directory}")
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def window(self, df):
+        '''
+        Record a watch() DataFrame
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._windows += 1
+            n = self._windows
+        self._safe(df.to_pickle, os.path.join(self.directory, "windows", f"{n:06d}.pkl"))
+
+    def image(self, url, data):
+        '''
+        Record the bytes of a downloaded image
+        '''
+        if not self.enabled:
+            return
+        self._safe(self._write, os.path.join(self.directory, "images", url_key(url)), data, "wb")
+
+    def manifest(self, vsn, manifest):
+        '''
+        Record the manifest of a node
+        '''
+        if not self.enabled:
+            return
+        self._safe(self._write, os.path.join(self.directory, "manifests", f"{vsn.upper()}.json"), json.dumps(manifest), "w")
+
+    def locations(self, df):
+        '''
+        Record the result of a GPS query
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._locations += 1
+            n = self._locations
+        self._safe(df.to_pickle, os.path.join(self.directory, "locations", f"{n:06d}.pkl"))
+
+    def _write(self, path, content, mode):
+        with open(path, mode) as f:
+            f.write(content)
+
+    def _safe(self, func, *args):
+        # Recording must never break loading
+        try:
+            func(*args)
+        except Exception as e:
+            logging.error(f"Failed to record fixture {args[0]}: {e}")
+
+# Recorder shared by the whole loader
+recorder = Recorder()
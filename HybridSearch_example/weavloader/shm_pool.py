@@ -0,0 +1,153 @@
+'''This file contains the shared memory transport to Triton. When the loader
+runs on the same host as Florence 2, images are written straight into system
+shared memory regions registered with Triton instead of being serialized into
+every gRPC request. A small pool creates the regions on demand, hands one out
+per image until its requests are done, and unregisters and removes them on exit.'''
+
+import os
+import atexit
+import logging
+import threading
+import numpy as np
+import tritonclient.grpc as TritonClient
+import tritonclient.utils.shared_memory as shm
+from tritonclient.utils import serialized_byte_size
+from metrics import metrics
+
+TRITON_SHM = os.environ.get("TRITON_SHM", "false").lower() == "true" # Send images through system shared memory, the loader & florence2 must share /dev/shm
+TRITON_SHM_REGIONS = int(os.environ.get("TRITON_SHM_REGIONS", 16)) # Max regions, every image being captioned holds one
+TRITON_SHM_REGION_SIZE = int(os.environ.get("TRITON_SHM_REGION_SIZE", 16 * 2**20)) # Bytes per region, larger images are sent over gRPC
+
+class Region:
+    '''
+    A shared memory region, inputs are written one after the other
+    '''
+    def __init__(self, name, key, size):
+        self.name = name
+        self.key = key
+        self.size = size
+        self.handle = shm.create_shared_memory_region(name, key, size)
+        self.offset = 0
+
+    def put(self, inp, array):
+        '''
+        Copy an array (BYTES already serialized) into the region and point the input at it
+        '''
+        byte_size = serialized_byte_size(array) if array.dtype == np.object_ else array.nbytes
+        shm.set_shared_memory_region(self.handle, [array], offset=self.offset)
+        inp.set_shared_memory(self.name, byte_size, offset=self.offset)
+        self.offset += byte_size
+
+    def view(self, inp, dtype, shape):
+        '''
+        Writable array in the region for the input, to fill it without an intermediate copy
+        '''
+        array = shm.get_contents_as_numpy(self.handle, dtype, shape, offset=self.offset)
+        byte_size = array.nbytes
+        inp.set_shared_memory(self.name, byte_size, offset=self.offset)
+        self.offset += byte_size
+        return array
+
+    def destroy(self):
+        shm.destroy_shared_memory_region(self.handle)
+
+class RegionPool:
+    '''
+    Reusable shared memory regions registered with every Triton instance of the loader
+    '''
+    def __init__(self, count=TRITON_SHM_REGIONS, region_size=TRITON_SHM_REGION_SIZE, prefix=None):
+        self.count = count
+        self.region_size = region_size
+        self.prefix = prefix or f"weavloader_{os.getpid()}" # every loader process has its own regions
+        self._regions = []
+        self._free = []
+        self._clients = []
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def register(self, url):
+        '''
+        Register the regions with the Triton instance at url, and the ones created later
+        '''
+        client = TritonClient.InferenceServerClient(url=url)
+        with self._lock:
+            self._clients.append(client)
+            for region in self._regions:
+                self._register(client, region)
+
+    def acquire(self, byte_size):
+        '''
+        A free region, blocks while all of them are in use. None when byte_size does not fit
+        '''
+        if byte_size > self.region_size:
+            metrics.incr("triton_shm_fallbacks")
+            return None
+
+        with self._released:
+            while not self._free and len(self._regions) >= self.count:
+                self._released.wait()
+            if self._free:
+                region = self._free.pop()
+            else:
+                region = self._create()
+            region.offset = 0
+            self._report()
+            return region
+
+    def release(self, region):
+        with self._released:
+            self._free.append(region)
+            self._report()
+            self._released.notify()
+
+    def close(self):
+        '''
+        Unregister the regions from Triton and remove them
+        '''
+        with self._lock:
+            for region in self._regions:
+                for client in self._clients:
+                    try:
+                        client.unregister_system_shared_memory(region.name)
+                    except Exception as e:
+                        logging.error(f"Failed to unregister shared memory region {region.name}: {e}")
+                region.destroy()
+            for client in self._clients:
+                client.close()
+            self._regions, self._free, self._clients = [], [], []
+
+    def _create(self):
+        name = f"{self.prefix}_{len(self._regions)}"
+        region = Region(name, f"/{name}", self.region_size)
+        for client in self._clients:
+            self._register(client, region)
+        self._regions.append(region)
+        logging.debug(f"Created shared memory region {name} of {self.region_size} bytes")
+        return region
+
+    def _register(self, client, region):
+        client.register_system_shared_memory(region.name, region.key, region.size)
+
+    def _report(self):
+        metrics.set_gauge("triton_shm_regions_in_use", len(self._regions) - len(self._free))
+
+_pool = None
+
+def open_region_pool(url):
+    '''
+    Create the region pool of this process and register it with the Triton instances in url
+    '''
+    global _pool
+    if _pool is None:
+        _pool = RegionPool()
+        atexit.register(_pool.close)
+    for u in url.split(","):
+        if u.strip():
+            _pool.register(u.strip())
+    return _pool
+
+def region_pool():
+    '''
+    The region pool of this process, None when the shared memory transport is not used
+    '''
+    return _pool
@@ -0,0 +1,344 @@
+'''This file contains the sources the loader reads images from. A source yields
+windows of rows with the same columns as sage_data_client and gives the fetcher
+that reads the image behind a row. Besides Sage (data API or broker), archived
+image dumps can be loaded from a local directory or an S3-compatible bucket.'''
+
+import os
+import io
+import re
+import time
+import logging
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from fetch import ImageFetcher
+from metrics import metrics
+
+SOURCE = os.environ.get("SOURCE", "") # "" for Sage, a directory or s3://bucket/prefix to load an archived image dump
+SOURCE_INDEX = os.environ.get("SOURCE_INDEX", "index.csv") # Index of the dump (.csv or .jsonl) with the data API columns, the dump is scanned when it is missing
+SOURCE_SCAN_INTERVAL = float(os.environ.get("SOURCE_SCAN_INTERVAL", 0)) # Seconds between scans for images newer than the last scan, 0 loads the dump once
+SOURCE_BATCH_SIZE = int(os.environ.get("SOURCE_BATCH_SIZE", 100)) # Rows fed to the pipeline as one window
+SOURCE_LIST_WORKERS = int(os.environ.get("SOURCE_LIST_WORKERS", 8)) # Directories or prefixes listed at the same time
+SOURCE_READ_WORKERS = int(os.environ.get("SOURCE_READ_WORKERS", 16)) # Images read at the same time
+SOURCE_MANIFESTS = os.environ.get("SOURCE_MANIFESTS", "true").lower() == "true" # Look up the node manifests of the dump, set to false for dumps not from Sage nodes
+S3_ENDPOINT = os.environ.get("S3_ENDPOINT", "") # Endpoint of an S3-compatible store, e.g. http://minio:9000, "" for AWS
+S3_PART_SIZE = int(os.environ.get("S3_PART_SIZE", 8 * 2**20)) # Objects larger than this are downloaded in concurrent ranged parts
+S3_PART_WORKERS = int(os.environ.get("S3_PART_WORKERS", 4)) # Ranged parts of one object downloaded at the same time
+
+# Columns of a sage_data_client row
+META_FIELDS = ("vsn", "filename", "camera", "host", "job", "node", "plugin", "task", "zone")
+COLUMNS = ["timestamp", "name", "value"] + [f"meta.{field}" for field in META_FIELDS]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+class Source:
+    '''
+    Where the loader gets new rows from, the default is reading Sage URLs
+    '''
+    manifests = True # rows come from Sage nodes that have a manifest
+    locations = True # rows come from Sage nodes with a live GPS fix
+
+    def cursor(self):
+        '''
+        Cursor committed as windows are done, or None
+        '''
+        return None
+
+    def windows(self):
+        '''
+        Yield DataFrames of new rows
+        '''
+        raise NotImplementedError
+
+    def fetcher(self, auth):
+        '''
+        Fetcher reading the image behind the value of a row
+        '''
+        return ImageFetcher(auth=auth)
+
+    def close(self):
+        pass
+
+def path_to_row(relpath, timestamp):
+    '''
+    Row of an image stored as <vsn>/<camera>/<filename>, a leading timestamp in ns
+    in the file name (as in Sage uploads) is used over the file time
+    '''
+    parts = relpath.replace("\\", "/").split("/")
+    filename = parts[-1]
+    match = re.match(r"^(\d{18,19})-", filename)
+    if match:
+        timestamp = pd.Timestamp(int(match.group(1)), unit="ns", tz="UTC")
+
+    row = {column: None for column in COLUMNS}
+    row.update({
+        "timestamp": timestamp,
+        "name": "upload",
+        "meta.vsn": parts[0] if len(parts) > 1 else "",
+        "meta.camera": parts[1] if len(parts) > 2 else "",
+        "meta.filename": filename,
+    })
+    return row
+
+def read_index(content, name):
+    '''
+    Parse an index of a dump, it has the data API columns and an optional "path"
+    column with the file of each row relative to the dump
+    '''
+    if name.endswith(".jsonl"):
+        df = pd.read_json(content, lines=True)
+    else:
+        df = pd.read_csv(content)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
+    for column in COLUMNS:
+        if column not in df.columns:
+            df[column] = None
+    # Rows without a node have an empty VSN, as the files at the top of a scanned dump
+    df["meta.vsn"] = df["meta.vsn"].fillna("").astype(str)
+    return df
+
+class ArchiveSource(Source):
+    '''
+    Base of the sources loading an image dump once, or rescanning it for images
+    newer than the ones already loaded
+    '''
+    locations = False # the live GPS fix is not where an archived image was taken
+
+    def __init__(self, scan_interval=SOURCE_SCAN_INTERVAL, batch_size=SOURCE_BATCH_SIZE):
+        self.manifests = SOURCE_MANIFESTS
+        self.scan_interval = scan_interval
+        self.batch_size = batch_size
+        self.paths = {} # value -> location in the dump, when the index links to another URL
+        self._newest = None # timestamp of the newest image loaded
+        self._at_newest = set() # values loaded with that timestamp
+
+    def windows(self):
+        while True:
+            start = time.perf_counter()
+            df = self.scan()
+            metrics.observe("source_scan", time.perf_counter() - start)
+
+            df = self._new_rows(df).sort_values("timestamp", ignore_index=True)
+            metrics.incr("source_rows", len(df))
+            logging.debug(f"Found {len(df)} new images in {self}")
+
+            for i in range(0, len(df), self.batch_size):
+                yield df.iloc[i:i + self.batch_size].reset_index(drop=True)
+
+            if self.scan_interval <= 0:
+                return
+            time.sleep(self.scan_interval)
+
+    def _new_rows(self, df):
+        # Only the rows newer than the last scan, images added to the dump with an older timestamp are not picked up
+        if self._newest is not None:
+            df = df[(df["timestamp"] > self._newest) | ((df["timestamp"] == self._newest) & ~df["value"].isin(self._at_newest))]
+        if len(df) > 0:
+            newest = df["timestamp"].max()
+            at_newest = set(df.loc[df["timestamp"] == newest, "value"])
+            self._at_newest = at_newest if newest != self._newest else self._at_newest | at_newest
+            self._newest = newest
+        return df
+
+    def scan(self):
+        '''
+        All rows of the dump, from its index or by listing it
+        '''
+        raise NotImplementedError
+
+    def _index_rows(self, df):
+        # Rows of the index keep their value (e.g. the Sage URL) so their object IDs match
+        if "path" in df.columns:
+            for value, path in zip(df["value"], df["path"]):
+                if pd.notna(path):
+                    self.paths[value] = self.locate(path)
+        else:
+            df["value"] = [self.locate(value) for value in df["value"]]
+        return df[COLUMNS]
+
+    def locate(self, relpath):
+        '''
+        Value of an image from its path relative to the dump
+        '''
+        raise NotImplementedError
+
+class FileFetcher:
+    '''
+    Reads images from local disk with bounded concurrency
+    '''
+    def __init__(self, paths=None, workers=SOURCE_READ_WORKERS):
+        self.workers = workers
+        self.paths = paths if paths is not None else {}
+
+    def fetch(self, url):
+        with open(self.paths.get(url, url), "rb") as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+class DirectorySource(ArchiveSource):
+    '''
+    Image dump in a local directory, laid out as <vsn>/<camera>/<filename> or described by an index
+    '''
+    def __init__(self, root, index=SOURCE_INDEX, **kwargs):
+        super().__init__(**kwargs)
+        self.root = os.path.abspath(root)
+        self.index = index
+
+    def __str__(self):
+        return self.root
+
+    def fetcher(self, auth):
+        return FileFetcher(self.paths)
+
+    def locate(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def _new_rows(self, df):
+        # Only the rows newer than the last scan, images added to the dump with an older timestamp are not picked up
+        if self._newest is not None:
+            df = df[(df["timestamp"] > self._newest) | ((df["timestamp"] == self._newest) & ~df["value"].isin(self._at_newest))]
+        if len(df) > 0:
+            newest = df["timestamp"].max()
+            at_newest = set(df.loc[df["timestamp"] == newest, "value"])
+            self._at_newest = at_newest if newest != self._newest else self._at_newest | at_newest
+            self._newest = newest
+        return df
+
+    def scan(self):
+        index_path = os.path.join(self.root, self.index) if self.index else ""
+        if index_path and os.path.exists(index_path):
+            return self._index_rows(read_index(index_path, index_path))
+
+        # Top level directories (usually one per node) are listed concurrently
+        entries = list(os.scandir(self.root))
+        rows = [self._row(entry) for entry in entries if self._is_image(entry)]
+        with ThreadPoolExecutor(max_workers=SOURCE_LIST_WORKERS) as executor:
+            for sub_rows in executor.map(self._walk, [entry.path for entry in entries if entry.is_dir()]):
+                rows.extend(sub_rows)
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def _walk(self, directory):
+        rows = []
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    rows.append(self._row(os.path.join(dirpath, filename)))
+        return rows
+
+    def _is_image(self, entry):
+        return entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)
+
+    def _row(self, path):
+        path = path.path if isinstance(path, os.DirEntry) else path
+        row = path_to_row(os.path.relpath(path, self.root), pd.Timestamp(os.path.getmtime(path), unit="s", tz="UTC"))
+        row["value"] = path
+        return row
+
+class ObjectStoreFetcher:
+    '''
+    Downloads objects from an S3-compatible store, large objects in concurrent ranged parts
+    '''
+    def __init__(self, client, paths=None, workers=SOURCE_READ_WORKERS):
+        from boto3.s3.transfer import TransferConfig
+        self.client = client
+        self.workers = workers
+        self.paths = paths if paths is not None else {}
+        self.config = TransferConfig(
+            multipart_threshold=S3_PART_SIZE,
+            multipart_chunksize=S3_PART_SIZE,
+            max_concurrency=S3_PART_WORKERS,
+        )
+
+    def fetch(self, url):
+        bucket, key = split_s3_url(self.paths.get(url, url))
+        buffer = io.BytesIO()
+        self.client.download_fileobj(bucket, key, buffer, Config=self.config)
+        return buffer.getvalue()
+
+    def close(self):
+        pass
+
+def split_s3_url(url):
+    '''
+    (bucket, key) of s3://bucket/key
+    '''
+    bucket, _, key = url[len("s3://"):].partition("/")
+    return bucket, key
+
+class ObjectStoreSource(ArchiveSource):
+    '''
+    Image dump in an S3-compatible bucket (e.g. MinIO), laid out like DirectorySource
+    '''
+    def __init__(self, url, index=SOURCE_INDEX, endpoint=S3_ENDPOINT, **kwargs):
+        import boto3
+        from botocore.config import Config
+        super().__init__(**kwargs)
+        self.bucket, prefix = split_s3_url(url)
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.index = index
+        # Credentials come from the usual AWS_ACCESS_KEY_ID & AWS_SECRET_ACCESS_KEY variables
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint or None,
+            config=Config(max_pool_connections=SOURCE_READ_WORKERS + SOURCE_LIST_WORKERS),
+        )
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+    def fetcher(self, auth):
+        return ObjectStoreFetcher(self.client, self.paths)
+
+    def locate(self, relpath):
+        return f"s3://{self.bucket}/{self.prefix}{relpath}"
+
+    def _new_rows(self, df):
+        # Only the rows newer than the last scan, images added to the dump with an older timestamp are not picked up
+        if self._newest is not None:
+            df = df[(df["timestamp"] > self._newest) | ((df["timestamp"] == self._newest) & ~df["value"].isin(self._at_newest))]
+        if len(df) > 0:
+            newest = df["timestamp"].max()
+            at_newest = set(df.loc[df["timestamp"] == newest, "value"])
+            self._at_newest = at_newest if newest != self._newest else self._at_newest | at_newest
+            self._newest = newest
+        return df
+
+    def scan(self):
+        if self.index:
+            try:
+                obj = self.client.get_object(Bucket=self.bucket, Key=self.prefix + self.index)
+                return self._index_rows(read_index(io.BytesIO(obj["Body"].read()), self.index))
+            except self.client.exceptions.NoSuchKey:
+                pass
+
+        # Prefixes below the dump (usually one per node) are listed concurrently
+        top = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix, Delimiter="/")
+        rows = [self._row(obj) for obj in top.get("Contents", []) if obj["Key"].lower().endswith(IMAGE_EXTENSIONS)]
+        prefixes = [common["Prefix"] for common in top.get("CommonPrefixes", [])]
+        with ThreadPoolExecutor(max_workers=SOURCE_LIST_WORKERS) as executor:
+            for sub_rows in executor.map(self._list, prefixes):
+                rows.extend(sub_rows)
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def _list(self, prefix):
+        rows = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"].lower().endswith(IMAGE_EXTENSIONS):
+                    rows.append(self._row(obj))
+        return rows
+
+    def _row(self, obj):
+        row = path_to_row(obj["Key"][len(self.prefix):], pd.Timestamp(obj["LastModified"]).tz_convert("UTC"))
+        row["value"] = f"s3://{self.bucket}/{obj['Key']}"
+        return row
+
+def open_archive_source(location=SOURCE):
+    '''
+    Source of an archived image dump, a local directory or s3://bucket/prefix
+    '''
+    if location.startswith("s3://"):
+        return ObjectStoreSource(location)
+    return DirectorySource(location[len("file://"):] if location.startswith("file://") else location)
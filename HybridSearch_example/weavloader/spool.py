@@ -0,0 +1,328 @@
+'''This file contains the dead-letter spool. Images that fail on a transient
+error (Sage storage, manifest API, Triton or Weaviate being down) are written
+to a local directory with their row metadata, the downloaded bytes and any
+result already computed. A retry worker feeds them back into the pipeline
+with exponential backoff, so an outage does not leave gaps in the index.'''
+
+import os
+import json
+import time
+import logging
+import requests
+import threading
+import pandas as pd
+from image import IngestImage
+from metrics import metrics
+
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "/app/state/spool") # Set to "" to disable the spool, failed images are then lost
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", 2**30)) # Byte budget of spooled image bytes, over it only the metadata is kept and the image is downloaded again
+SPOOL_RETRY_INTERVAL = float(os.environ.get("SPOOL_RETRY_INTERVAL", 10)) # Seconds between checks for images that are due for a retry
+SPOOL_RETRY_CONCURRENCY = int(os.environ.get("SPOOL_RETRY_CONCURRENCY", 4)) # Max retried images in the pipeline at the same time
+SPOOL_BACKOFF = float(os.environ.get("SPOOL_BACKOFF", 30)) # Seconds before the first retry, doubled on every failed attempt
+SPOOL_MAX_BACKOFF = float(os.environ.get("SPOOL_MAX_BACKOFF", 3600)) # Max seconds between two retries
+SPOOL_MAX_ATTEMPTS = int(os.environ.get("SPOOL_MAX_ATTEMPTS", 20)) # Attempts before an image is given up
+
+# Row metadata kept in a spooled entry, everything else is rebuilt on retry
+METADATA_FIELDS = ("url", "timestamp", "vsn", "filename", "camera", "host", "job", "node", "plugin", "task", "zone", "uuid", "location")
+# Results of earlier stages that are kept so a retry does not redo them
+RESULT_FIELDS = ("encoded_image", "thumbnail", "caption")
+
+def retryable(stage, e):
+    '''
+    True if the error can go away on its own and the image should be retried
+    '''
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        # The image or node does not exist, except for timeouts and rate limits
+        status = e.response.status_code
+        return status >= 500 or status in (408, 429)
+    if isinstance(e, requests.exceptions.RequestException):
+        return True
+    # Files and objects of an archive that do not exist
+    if isinstance(e, FileNotFoundError):
+        return False
+    if isinstance(getattr(e, "response", None), dict) and e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+        return False
+    # Undecodable images fail the same way every time
+    return stage != "decode"
+
+class DeadLetterSpool:
+    '''
+    Failed images stored as <uuid>.json (metadata and results) plus <uuid>.bin (image bytes)
+    '''
+    def __init__(self, directory=SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES, concurrency=SPOOL_RETRY_CONCURRENCY,
+                 backoff=SPOOL_BACKOFF, max_backoff=SPOOL_MAX_BACKOFF, max_attempts=SPOOL_MAX_ATTEMPTS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._budget = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._due = {} # uuid -> time of the next attempt
+        self._in_flight = set()
+        self._bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def add(self, record, stage, error, attempt=True):
+        '''
+        Spool a failed image, or give it up after too many attempts.
+        Images that did not fail, e.g. shed by the fair queue, are spooled with attempt=False.
+        '''
+        uuid = record["uuid"]
+        attempts = record.get("attempts", 0) + (1 if attempt else 0)
+        if attempts > self.max_attempts:
+            logging.error(f"Image given up after {attempts - 1} attempts for URL {record['url']}: {error}")
+            metrics.incr("spool_given_up")
+            self._delete(uuid)
+            record["given_up"] = True
+            return
+
+        delay = min(self.max_backoff, self.backoff * 2 ** max(attempts - 1, 0))
+        entry = {
+            "record": {field: record[field] for field in METADATA_FIELDS + RESULT_FIELDS if record.get(field) is not None},
+            "stage": stage,
+            "error": str(error),
+            "attempts": attempts,
+            "next_attempt": time.time() + delay,
+        }
+        entry["record"]["timestamp"] = pd.Timestamp(record["timestamp"]).isoformat()
+
+        image = record.get("image")
+        data = image.data if image is not None else None
+
+        with self._lock:
+            # Keep the image bytes only while there is room, a retry downloads them again otherwise
+            old_size = self._bin_size(uuid)
+            if data and self._bytes - old_size + len(data) > self.max_bytes:
+                metrics.incr("spool_bytes_dropped")
+                data = None
+            try:
+                self._write(uuid, entry, data)
+            except Exception as e:
+                logging.error(f"Failed to spool image for URL {record['url']}, it is lost: {e}")
+                return
+            self._bytes += (len(data) if data else 0) - old_size
+            self._due[uuid] = entry["next_attempt"]
+            record["spooled"] = True
+            self._report()
+
+        metrics.incr("spool_added")
+        logging.debug(f"Image spooled after failing in stage {stage}, attempt {attempts} in {delay:.0f}s for URL {record['url']}")
+
+    def release(self, record):
+        '''
+        Called once a retried image left the pipeline. The entry is removed unless the
+        image failed again and was spooled for the next attempt, or was given up.
+        '''
+        if "attempts" not in record:
+            return
+        uuid = record["uuid"]
+        with self._lock:
+            if uuid not in self._in_flight:
+                return
+            self._in_flight.discard(uuid)
+        self._budget.release()
+
+        if not record.get("spooled") and not record.get("given_up"):
+            self._delete(uuid)
+            metrics.incr("spool_recovered")
+
+    def pending(self):
+        '''
+        Number of spooled images, including the ones being retried
+        '''
+        with self._lock:
+            return len(self._due)
+
+    def due(self):
+        '''
+        Load the images due for a retry, as many as the concurrency budget allows
+        '''
+        now = time.time()
+        with self._lock:
+            uuids = sorted(
+                (next_attempt, uuid) for uuid, next_attempt in self._due.items()
+                if next_attempt <= now and uuid not in self._in_flight
+            )
+
+        records = []
+        for _, uuid in uuids:
+            if not self._budget.acquire(blocking=False):
+                break
+            try:
+                record = self._read(uuid)
+            except Exception as e:
+                logging.error(f"Failed to read spooled image {uuid}, dropping it: {e}")
+                self._budget.release()
+                self._delete(uuid)
+                continue
+            with self._lock:
+                self._in_flight.add(uuid)
+            records.append(record)
+        return records
+
+    def adopt(self, directory, owns=None):
+        '''
+        Move the entries left in the spool of another worker layout into this one,
+        only the ones of the nodes owns() accepts when it is given
+        '''
+        adopted = 0
+        for name in os.listdir(directory):
+            uuid, ext = os.path.splitext(name)
+            if ext != ".json":
+                continue
+            try:
+                with open(os.path.join(directory, name), "r") as f:
+                    entry = json.load(f)
+                if owns is not None and not owns(entry["record"]["vsn"]):
+                    continue
+                # The bytes are moved first, an entry only exists once it is complete
+                if os.path.exists(os.path.join(directory, f"{uuid}.bin")):
+                    os.replace(os.path.join(directory, f"{uuid}.bin"), self._path(uuid, "bin"))
+                os.replace(os.path.join(directory, name), self._path(uuid, "json"))
+            except Exception as e:
+                logging.error(f"Failed to adopt spooled image {name} from {directory}: {e}")
+                continue
+            with self._lock:
+                self._bytes += self._bin_size(uuid)
+                self._due[uuid] = entry["next_attempt"]
+            adopted += 1
+
+        if adopted:
+            logging.debug(f"Adopted {adopted} spooled images from {directory}")
+            with self._lock:
+                self._report()
+
+    def start(self, feed):
+        '''
+        Start the retry worker, feed puts a record into the pipeline
+        '''
+        self._thread = threading.Thread(target=self._retry_loop, args=(feed,), name="spool-retry", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _retry_loop(self, feed):
+        while not self._stop.wait(SPOOL_RETRY_INTERVAL):
+            for record in self.due():
+                metrics.incr("spool_retries")
+                logging.debug(f"Retrying spooled image, attempt {record['attempts'] + 1} for URL {record['url']}")
+                feed(record)
+
+    def _read(self, uuid):
+        with open(self._path(uuid, "json"), "r") as f:
+            entry = json.load(f)
+
+        record = entry["record"]
+        record["timestamp"] = pd.Timestamp(record["timestamp"])
+        record["attempts"] = entry["attempts"]
+        if os.path.exists(self._path(uuid, "bin")):
+            with open(self._path(uuid, "bin"), "rb") as f:
+                record["image"] = IngestImage(f.read())
+        return record
+
+    def _write(self, uuid, entry, data):
+        # The json file is written last, an entry only exists once it is complete
+        if data:
+            self._atomic_write(self._path(uuid, "bin"), data, "wb")
+        elif os.path.exists(self._path(uuid, "bin")):
+            os.remove(self._path(uuid, "bin"))
+        self._atomic_write(self._path(uuid, "json"), json.dumps(entry), "w")
+
+    def _atomic_write(self, path, content, mode):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, mode) as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _delete(self, uuid):
+        with self._lock:
+            self._bytes -= self._bin_size(uuid)
+            self._due.pop(uuid, None)
+            for ext in ("json", "bin"):
+                try:
+                    os.remove(self._path(uuid, ext))
+                except FileNotFoundError:
+                    pass
+            self._report()
+
+    def _load_index(self):
+        # Rebuild the schedule from the entries left by the last run
+        for name in os.listdir(self.directory):
+            uuid, ext = os.path.splitext(name)
+            if ext == ".json":
+                try:
+                    with open(os.path.join(self.directory, name), "r") as f:
+                        self._due[uuid] = json.load(f)["next_attempt"]
+                except Exception as e:
+                    logging.error(f"Dropping unreadable spool entry {name}: {e}")
+                    os.remove(os.path.join(self.directory, name))
+
+        # Remove image bytes and temp files without an entry
+        for name in os.listdir(self.directory):
+            uuid, ext = os.path.splitext(name)
+            if ext == ".tmp" or (ext == ".bin" and uuid not in self._due):
+                os.remove(os.path.join(self.directory, name))
+            elif ext == ".bin":
+                self._bytes += os.path.getsize(os.path.join(self.directory, name))
+
+        if self._due:
+            logging.debug(f"Loaded {len(self._due)} spooled images from {self.directory}")
+        self._report()
+
+    def _bin_size(self, uuid):
+        try:
+            return os.path.getsize(self._path(uuid, "bin"))
+        except FileNotFoundError:
+            return 0
+
+    def _path(self, uuid, ext):
+        return os.path.join(self.directory, f"{uuid}.{ext}")
+
+    def _report(self):
+        metrics.set_gauge("spool_entries", len(self._due))
+        metrics.set_gauge("spool_bytes", self._bytes)
+
+def open_spool(directory=SPOOL_DIR, partition=None):
+    '''
+    Open the spool if it is enabled, sharded workers get a directory each. The entries
+    left by another worker layout are adopted by the workers that now own their nodes.
+    '''
+    if not directory:
+        return None
+    sharded = partition is not None and partition.worker_count > 1
+    root = directory
+    if sharded:
+        directory = os.path.join(root, f"worker-{partition.worker_index}")
+    try:
+        spool = DeadLetterSpool(directory)
+    except Exception as e:
+        logging.error(f"Failed to open spool {directory}, failed images will not be retried: {e}")
+        return None
+
+    for orphan in orphaned_spools(root, partition.worker_count if sharded else 1):
+        try:
+            spool.adopt(orphan, partition.owns if sharded else None)
+        except Exception as e:
+            logging.error(f"Failed to adopt the spool {orphan}: {e}")
+    return spool
+
+def orphaned_spools(root, worker_count):
+    '''
+    Spool directories no worker of the layout uses: the spool of a single worker
+    once sharded, and the directories of workers past worker_count
+    '''
+    orphans = [root] if worker_count > 1 else []
+    for name in os.listdir(root):
+        index = name[len("worker-"):]
+        if name.startswith("worker-") and index.isdigit() and int(index) >= (worker_count if worker_count > 1 else 0):
+            orphans.append(os.path.join(root, name))
+    return orphans
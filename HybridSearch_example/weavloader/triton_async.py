@@ -0,0 +1,108 @@
+'''This file contains the asynchronous Triton client. Requests run on an asyncio
+event loop in a background thread with tritonclient.grpc.aio, so the caption
+workers hand over an image and move on instead of waiting while Florence 2
+generates. A bounded number of requests is kept in flight per Triton
+instance, enough to keep the server busy without flooding it.'''
+
+import os
+import asyncio
+import logging
+import threading
+import tritonclient.grpc as TritonClient
+import tritonclient.grpc.aio as TritonAioClient
+from metrics import metrics
+from shm_pool import open_region_pool, TRITON_SHM
+
+TRITON_URL = os.environ.get("TRITON_URL", "florence2:8001") # gRPC url of Florence 2, a comma separated list spreads the load over several instances
+TRITON_ASYNC = os.environ.get("TRITON_ASYNC", "true").lower() == "true" # Keep several requests in flight with the asyncio client, false blocks a caption worker per request
+TRITON_MAX_IN_FLIGHT = int(os.environ.get("TRITON_MAX_IN_FLIGHT", 4)) # Max requests in flight per Triton instance
+
+class _Instance:
+    '''
+    aio client of one Triton instance and its in-flight limit
+    '''
+    def __init__(self, url, client, max_in_flight):
+        self.url = url
+        self.client = client
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0 # requests sent or waiting for a slot
+
+class AsyncTriton:
+    '''
+    Runs coroutines using infer() on a background event loop, submit() returns a
+    concurrent.futures.Future that can be handed to the ingest pipeline
+    '''
+    def __init__(self, url=TRITON_URL, max_in_flight=TRITON_MAX_IN_FLIGHT, connect=None):
+        self.urls = [u.strip() for u in url.split(",") if u.strip()]
+        self.max_in_flight = max_in_flight
+        self._connect = connect or (lambda url: TritonAioClient.InferenceServerClient(url=url))
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="triton-async", daemon=True)
+        self._thread.start()
+
+        # The aio clients have to be created on the loop they run on
+        self._instances = self._run(self._open()).result()
+
+    @property
+    def capacity(self):
+        '''
+        Max requests in flight over all instances
+        '''
+        return self.max_in_flight * len(self._instances)
+
+    def submit(self, coro):
+        '''
+        Schedule a coroutine on the event loop, safe to call from any thread
+        '''
+        return self._run(coro)
+
+    async def infer(self, model_name, inputs, outputs=None):
+        '''
+        Run a request on the least busy instance, waits while every instance is at its limit
+        '''
+        instance = min(self._instances, key=lambda instance: instance.in_flight)
+        instance.in_flight += 1
+        self._report()
+        try:
+            async with instance.slots:
+                with metrics.timer("triton_request"):
+                    return await instance.client.infer(model_name=model_name, inputs=inputs, outputs=outputs)
+        finally:
+            instance.in_flight -= 1
+            self._report()
+
+    def close(self):
+        try:
+            self._run(self._close()).result(timeout=10)
+        except Exception as e:
+            logging.error(f"Failed to close the Triton clients: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _open(self):
+        return [_Instance(url, self._connect(url), self.max_in_flight) for url in self.urls]
+
+    async def _close(self):
+        for instance in self._instances:
+            close = getattr(instance.client, "close", None)
+            if close is not None:
+                await close()
+
+    def _report(self):
+        metrics.set_gauge("triton_in_flight", sum(instance.in_flight for instance in self._instances))
+
+def open_triton_client(url=TRITON_URL):
+    '''
+    Async client keeping requests in flight, or the blocking client of the first instance
+    '''
+    # Images are written into shared memory regions registered with every instance
+    if TRITON_SHM:
+        open_region_pool(url)
+
+    if TRITON_ASYNC:
+        return AsyncTriton(url)
+    return TritonClient.InferenceServerClient(url=url.split(",")[0].strip())
@@ -0,0 +1,111 @@
+'''This file contains the code to insert objects into weaviate in batches'''
+
+import os
+import time
+import logging
+import threading
+from metrics import metrics
+
+INSERT_BATCH_MODE = os.environ.get("INSERT_BATCH_MODE", "dynamic") # "dynamic" or "fixed"
+INSERT_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", 50)) # Objects collected before a batch is flushed
+INSERT_IDLE_TIMEOUT = float(os.environ.get("INSERT_IDLE_TIMEOUT", 5.0)) # Max seconds an object waits before it is flushed
+INSERT_CONCURRENT_REQUESTS = int(os.environ.get("INSERT_CONCURRENT_REQUESTS", 2)) # Only used by the fixed size batch
+
+class BatchWriter:
+    '''
+    Collects objects and inserts them with weaviate batch imports, so the vectorizer
+    receives whole batches instead of one object at a time. A batch is flushed when
+    it is full or when its oldest object waited longer than the idle timeout.
+    '''
+    def __init__(self, collection, batch_size=INSERT_BATCH_SIZE, idle_timeout=INSERT_IDLE_TIMEOUT,
+                 mode=INSERT_BATCH_MODE, on_flush=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.mode = mode
+        self.on_flush = on_flush # called with (objects, failed_objects) after every successful flush
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._idle_thread = threading.Thread(target=self._flush_on_idle, name="batch-idle-flush", daemon=True)
+        self._idle_thread.start()
+
+    def add(self, properties, uuid=None, ref=None):
+        '''
+        Queue an object for insertion, ref is handed back to on_flush
+        '''
+        with self._lock:
+            self._buffer.append({"properties": properties, "uuid": uuid, "ref": ref})
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = len(self._buffer) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''
+        Insert all queued objects, returns the failed objects
+        '''
+        with self._flush_lock:
+            with self._lock:
+                objects, self._buffer = self._buffer, []
+                self._oldest = None
+
+            if not objects:
+                return []
+
+            try:
+                with metrics.timer("insert_batch"):
+                    with self._batch() as batch:
+                        for obj in objects:
+                            batch.add_object(properties=obj["properties"], uuid=obj["uuid"])
+            except Exception as e:
+                # Keep the objects so the next flush retries them
+                logging.error(f"Batch insert failed, retrying {len(objects)} objects on next flush: {e}")
+                metrics.incr("insert_batch_errors")
+                with self._lock:
+                    self._buffer = objects + self._buffer
+                    self._oldest = time.monotonic()
+                return []
+
+            # Report the objects weaviate rejected
+            failed_objects = self.collection.batch.failed_objects
+            for failed in failed_objects:
+                logging.error(f"Image skipped, insert failed for URL {failed.object_.properties.get('link')}: {failed.message}")
+
+            metrics.incr("insert_objects", len(objects) - len(failed_objects))
+            metrics.incr("insert_failed", len(failed_objects))
+            logging.debug(f"Batch inserted: {len(objects) - len(failed_objects)} added, {len(failed_objects)} failed")
+
+            if self.on_flush is not None:
+                self.on_flush(objects, failed_objects)
+
+            return failed_objects
+
+    def close(self):
+        '''
+        Stop the idle flusher and insert what is left
+        '''
+        self._stop.set()
+        self._idle_thread.join()
+        self.flush()
+
+    def _batch(self):
+        if self.mode == "fixed":
+            return self.collection.batch.fixed_size(batch_size=self.batch_size, concurrent_requests=INSERT_CONCURRENT_REQUESTS)
+        return self.collection.batch.dynamic()
+
+    def _flush_on_idle(self):
+        # Check often enough that no object waits much longer than the idle timeout
+        interval = max(self.idle_timeout / 4, 0.1)
+        while not self._stop.wait(interval):
+            with self._lock:
+                expired = self._oldest is not None and time.monotonic() - self._oldest >= self.idle_timeout
+            if expired:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.error(f"Failed to flush batch on idle: {e}")
@@ -0,0 +1,12 @@
+from weaviate.classes.config import Property, DataType
+
+def run(client):
+    """Add the optional thumbnail stored by the loader"""
+    # The thumbnail is not part of the multi2vec-bind fields, so it is stored but not vectorized
+    # https://weaviate.io/developers/weaviate/manage-data/collections#add-a-property
+    collection = client.collections.get("HybridSearchExample")
+    collection.config.add_property(
+        Property(name="thumbnail", data_type=DataType.BLOB)
+    )
+
+    return
@@ -0,0 +1,127 @@
+'''This file contains the content-addressed caption cache. Captions are keyed
+by the SHA-256 of the image plus the Florence 2 settings, so an image that is
+loaded again (reloads, schema migrations, re-runs) skips Triton entirely.'''
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+CAPTION_CACHE_PATH = os.environ.get("CAPTION_CACHE_PATH", "/app/cache/captions.sqlite") # Set to "" to disable the cache
+CAPTION_CACHE_BYTES = int(os.environ.get("CAPTION_CACHE_BYTES", 256 * 2**20)) # Byte budget, least recently used captions are evicted
+# Florence 2 settings that change the captions, keep in sync with florence2/HyperParameters.py
+FLORENCE_HYPERPARAMETERS = os.environ.get(
+    "FLORENCE_HYPERPARAMETERS",
+    "model=florence2base,max_new_tokens=512,early_stopping=False,do_sample=False,num_beams=2"
+)
+
+def settings_fingerprint(**settings):
+    '''
+    Short hash of the settings that change a caption
+    '''
+    settings["florence"] = FLORENCE_HYPERPARAMETERS
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+class CaptionCache:
+    '''
+    Disk backed caption cache stored in SQLite with LRU eviction under a byte budget
+    '''
+    def __init__(self, path=CAPTION_CACHE_PATH, max_bytes=CAPTION_CACHE_BYTES, fingerprint=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint or settings_fingerprint()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, caption TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS captions_last_access ON captions (last_access)")
+        self._db.commit()
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM captions").fetchone()[0]
+
+    def key(self, data):
+        '''
+        Cache key of the image bytes under the current Florence 2 settings
+        '''
+        return f"{hashlib.sha256(data).hexdigest()}:{self.fingerprint}"
+
+    def get(self, key):
+        '''
+        Get a cached caption or None
+        '''
+        with self._lock:
+            row = self._db.execute("SELECT caption FROM captions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE captions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, caption):
+        '''
+        Store a caption and evict the least recently used ones over the byte budget
+        '''
+        size = len(key) + len(caption.encode("utf-8"))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM captions WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO captions (key, caption, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, caption, size, time.time()),
+            )
+            self._bytes += size - (old[0] if old else 0)
+
+            while self._bytes > self.max_bytes:
+                evicted = self._db.execute(
+                    "SELECT key, size FROM captions ORDER BY last_access LIMIT 100"
+                ).fetchall()
+                if not evicted:
+                    break
+                for evicted_key, evicted_size in evicted:
+                    self._db.execute("DELETE FROM captions WHERE key = ?", (evicted_key,))
+                    self._bytes -= evicted_size
+                    if self._bytes <= self.max_bytes:
+                        break
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def open_caption_cache(**settings):
+    '''
+    Open the cache if it is enabled, the loader keeps running without it on errors
+    '''
+    if not CAPTION_CACHE_PATH:
+        return None
+    try:
+        return CaptionCache(fingerprint=settings_fingerprint(**settings))
+    except Exception as e:
+        logging.error(f"Failed to open caption cache {CAPTION_CACHE_PATH}, captions will not be cached: {e}")
+        return None
+
+def cached_caption(cache, data, generate):
+    '''
+    Get the caption of the image bytes from the cache, or generate and store it
+    '''
+    if cache is None:
+        return generate()
+
+    key = cache.key(data)
+    caption = cache.get(key)
+    if caption is not None:
+        return caption
+
+    caption = generate()
+    cache.put(key, caption)
+    return caption
@@ -11,15 +11,17 @@ from datasets import load_dataset
 from io import BytesIO, BufferedReader
 from PIL import Image
 from model import triton_gen_caption
+from caption_cache import open_caption_cache, cached_caption
 from weaviate.classes.data import GeoCoordinate
 from itertools import islice
 
 # Load INQUIRE benchmark dataset from Hugging Face
 INQUIRE_DATASET = os.environ.get("INQUIRE_DATASET", "sagecontinuum/INQUIRE-Benchmark-small")
 
-def process_batch(batch, triton_client):
+def process_batch(batch, triton_client, caption_cache=None):
     """
     Process a batch of images and return formatted data for Weaviate.
+    Captions of images loaded before are taken from the caption cache.
     """
     formatted_data = []
     
@@ -63,12 +65,15 @@ def process_batch(batch, triton_client):
             image.save(image_stream, format="JPEG")
             image_stream.seek(0)
 
+            # Encoded image bytes, the key of the caption cache
+            image_bytes = image_stream.getvalue()
+
             # Encode image for Weaviate
             buffered_stream = BufferedReader(image_stream)
             encoded_image = weaviate.util.image_encoder_b64(buffered_stream)
 
-            # Generate caption using Florence-2
-            florence_caption = triton_gen_caption(triton_client, image)
+            # Generate caption using Florence-2, keyed by the SHA-256 of the encoded image
+            florence_caption = cached_caption(caption_cache, image_bytes, lambda: triton_gen_caption(triton_client, image))
 
             # Construct data for Weaviate
             data_properties = {
@@ -138,12 +143,15 @@ def load_inquire_data(weaviate_client, triton_client, batch_size=0, sample_size=
     # Get Weaviate collection
     collection = weaviate_client.collections.get("INQUIRE")
 
+    # Captions generated by earlier runs
+    caption_cache = open_caption_cache()
+
     # If workers is set to -1, process batches sequentially
     if workers == -1:
         logging.debug("Processing sequentially (no parallelization).")
         
         for batch in batched(dataset, batch_size):
-            formatted_data = process_batch(batch, triton_client)
+            formatted_data = process_batch(batch, triton_client, caption_cache)
             
             # Batch insert into Weaviate
             with collection.batch.fixed_size(batch_size=batch_size) as batch:
@@ -165,7 +173,7 @@ def load_inquire_data(weaviate_client, triton_client, batch_size=0, sample_size=
         with ThreadPoolExecutor(max_workers=workers) as executor:
             futures = []
             for batch in batched(dataset, batch_size):
-                futures.append(executor.submit(process_batch, batch, triton_client))
+                futures.append(executor.submit(process_batch, batch, triton_client, caption_cache))
 
             # Prepare a batch process for Weaviate
             with collection.batch.fixed_size(batch_size=batch_size) as batch:
@@ -184,6 +192,9 @@ def load_inquire_data(weaviate_client, triton_client, batch_size=0, sample_size=
     if failed_objects:
         logging.debug(f"Number of failed imports: {len(failed_objects)}")
 
+    if caption_cache is not None:
+        logging.debug(f"Caption cache hits: {caption_cache.hits}, misses: {caption_cache.misses}")
+
     logging.debug(f"{INQUIRE_DATASET} dataset successfully loaded into Weaviate")
 
 def reload_inquire_data(weaviate_client, triton_client, batch_size=0, sample_size=0, workers=-1):